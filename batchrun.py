@@ -0,0 +1,214 @@
+import multiprocessing
+import Queue
+import os
+import traceback
+import tables
+import condatiscore as cc
+import condatisHDF as chdf
+import logging
+
+"""
+Run many scenarios of one HDF project together.
+
+Each scenario is solved in memory by a worker process of a pool, using a
+plain CondatisCore, so no worker opens the project. Its inputs and
+results come back to the calling process, which forwards them over a
+queue to a single writer process, the only one with the project open
+(PyTables does not support several processes writing one file). The
+writer adds each scenario to the project as it arrives; as only the
+calling process puts on the queue, the end marker can't overtake a
+result. The scenarios are then just as if made with
+CondatisCoreHDF.fromLandscape() and calc(): a later calc() on the same
+inputs reuses the results rather than solving again.
+"""
+
+
+class Scenario(object):
+    """
+    One scenario of a batch.
+
+    Args:
+    name: (string), Name of the scenario in the project. An existing
+          scenario of that name is replaced.
+    habitat: (Landscape), Habitat quality.
+    source: (Landscape), Source cells.
+    target: (Landscape), Target cells.
+    R: (number), Species reproductive rate.
+    dispersal: (number), Species dispersal distance.
+    options: (dict, Optional), Computation options, as the name of a
+             CondatisCore setter and the keyword arguments to call it
+             with, e.g. {'setSparse': {'tol': 1e-9}}.
+    """
+    def __init__(self,name,habitat,source,target,R=100.0,dispersal=4.0,options=None):
+        self.name=name
+        self.habitat=habitat
+        self.source=source
+        self.target=target
+        self.R=R
+        self.dispersal=dispersal
+        self.options=options or {}
+
+    def apply(self,c):
+        """
+        Set the parameters and options on a core.
+        """
+        c.setParams(self.R,self.dispersal)
+        for name,kw in sorted(self.options.items()):
+            if not name.startswith('set'):
+                raise ValueError("Scenario %s: '%s' is not an option setter" % (self.name,name))
+            getattr(c,name)(**kw)
+
+
+# Seconds between checks that the writer is still running
+POLL=1.0
+
+def _solve(scn):
+    # One scenario, in a worker: (name,'ok',result) or (name,'error',message)
+    try:
+        c=cc.CondatisCore(scn.habitat)
+        c.addSource(scn.source)
+        c.addTarget(scn.target)
+        scn.apply(c)
+        c.calc()
+        res=(scn,c.habitatL(),
+             {'V0':c.V0_,'I':c.I_,'ipv_in':c.cin_,'ipv_out':c.cout_},
+             (c.cond_,c.tls_))
+    except Exception, e:
+        return scn.name,'error',str(e)+"\n"+traceback.format_exc()
+    return scn.name,'ok',res
+
+
+def _writer(projname,title,queue,conn,storage):
+    # The only process with the project open. Takes results off the queue
+    # until None, then reports (name,status,value) for each.
+    out=[]
+    try:
+        if os.path.exists(projname):
+            h5=tables.open_file(projname,mode='a')
+        else:
+            h5=chdf.makeProject(projname,title)
+    except Exception, e:
+        conn.send([(None,'error',str(e)+"\n"+traceback.format_exc())])
+        # Keep draining so runBatch() doesn't block on a full queue
+        while queue.get() is not None:
+            pass
+        return
+    try:
+        while True:
+            res=queue.get()
+            if res is None:
+                break
+            scn,hab,arrays,meta=res
+            try:
+                if h5.root.scenarios.__contains__(scn.name):
+                    h5.remove_node("/scenarios",scn.name,recursive=True)
+                c=chdf.CondatisCoreHDF.fromLandscape(h5,scn.name,hab)
+                c.setStorage(**storage)
+                c._addSource(scn.source)
+                c._addTarget(scn.target)
+                c.generateCombinedHabitat()
+                scn.apply(c)
+                c.putResults(arrays,meta)
+                out.append((scn.name,'ok',c.speed()))
+                logging.debug("batch: scenario %s written, speed %e" % (scn.name,c.speed()))
+            except Exception, e:
+                out.append((scn.name,'error',str(e)+"\n"+traceback.format_exc()))
+    finally:
+        h5.close()
+        conn.send(out)
+        conn.close()
+
+
+def _checkWriter(writer):
+    if not writer.is_alive():
+        raise RuntimeError("runBatch(): the writer process stopped (exit code %s)" % writer.exitcode)
+
+
+def _put(queue,item,writer):
+    # Put on the queue without waiting forever on a dead writer
+    while True:
+        try:
+            queue.put(item,timeout=POLL)
+            return
+        except Queue.Full:
+            _checkWriter(writer)
+
+
+def runBatch(projname,scenarios,nproc=None,title='Condatis',storage=None):
+    """
+    Solve scenarios in parallel and write them all to one project.
+
+    Args:
+    projname: (string), The HDF project file. Made (see
+              condatisHDF.makeProject()) if missing. It must not be open
+              elsewhere while the batch runs.
+    scenarios: (list of Scenario), The scenarios; their names must differ.
+    nproc: (int, Optional), Number of workers. Defaults to the number of CPUs.
+    title: (string), Title of a new project.
+    storage: (dict, Optional), Keyword arguments of
+             CondatisCoreHDF.setStorage() for the results.
+
+    Returns:
+    A list of the speed of each scenario, in the order of scenarios.
+
+    Scenarios are added to the project in the order they finish. Any that
+    fail are left out and reported together in a RuntimeError once the
+    rest are written. If the writer process dies the workers are stopped
+    and a RuntimeError raised at once.
+    """
+    names=[s.name for s in scenarios]
+    if len(set(names))!=len(names):
+        raise ValueError("runBatch(): scenario names must differ")
+    if nproc is None:
+        nproc=multiprocessing.cpu_count()
+    nproc=max(1,min(nproc,len(scenarios)))
+    queue=multiprocessing.Queue(2*nproc)
+    a,b=multiprocessing.Pipe(False)
+    writer=multiprocessing.Process(target=_writer,args=(projname,title,queue,b,storage or {}))
+    writer.start()
+    # Only the writer keeps the send end, so a.recv() sees EOF if it dies
+    b.close()
+    failed=[]
+    pool=multiprocessing.Pool(nproc)
+    try:
+        # Never block on the workers, queue or pipe without checking the
+        # writer is still there
+        results=pool.imap_unordered(_solve,scenarios)
+        for k in range(len(scenarios)):
+            while True:
+                try:
+                    name,status,res=results.next(POLL)
+                    break
+                except multiprocessing.TimeoutError:
+                    _checkWriter(writer)
+            if status=='ok':
+                _put(queue,res,writer)
+            else:
+                failed.append((name,res))
+        pool.close()
+        _put(queue,None,writer)
+        while not a.poll(POLL):
+            _checkWriter(writer)
+        try:
+            written=a.recv()
+        except EOFError:
+            raise RuntimeError("runBatch(): the writer process stopped (exit code %s)" % writer.exitcode)
+    except:
+        pool.terminate()
+        pool.join()
+        if writer.is_alive():
+            writer.terminate()
+        writer.join()
+        raise
+    pool.join()
+    writer.join()
+    speed={}
+    for name,status,v in written:
+        if status=='ok':
+            speed[name]=v
+        else:
+            failed.append((name,v))
+    if failed:
+        raise RuntimeError("runBatch(): %d scenario(s) failed:\n%s"
+                           % (len(failed),"\n".join("%s: %s" % f for f in failed)))
+    return [speed[n] for n in names]
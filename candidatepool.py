@@ -0,0 +1,140 @@
+import numpy as np
+import multiprocessing
+from multiprocessing import sharedctypes
+from scipy import linalg
+from scipy.sparse import linalg as splinalg
+import solvers
+import logging
+
+"""
+Exact speed loss from removing single habitat cells, evaluated in
+parallel worker processes.
+
+Removing cell k cuts its links, so every other cell j loses c_jk from
+its M0 diagonal, and row and column k drop out (here: decoupled to an
+identity row with a zero right hand side). With m the off-diagonal part
+of column k of M0 (m_j = -c_jk), the new system is
+
+    M0' x = M0 x + m*(x - x_k),   (M0' x)_k = x_k
+
+so each candidate is solved by conjugate gradient using only M0 itself,
+started from the current V0 and preconditioned by the existing Cholesky
+factor of M0. M0 differs from M0' by a rank two change plus small
+diagonal terms, so this takes a handful of iterations.
+
+M0, its factor, cin, cout and V0 are written into shared memory once per
+round, and the workers read them in place rather than having them
+pickled. Only the dense float64 system is supported.
+"""
+
+_shared={}
+
+
+def _init(buffers):
+    _shared.update(buffers)
+
+
+def _view(buffers,name,shape):
+    return np.frombuffer(buffers[name],dtype=np.float64,count=int(np.prod(shape))).reshape(shape)
+
+
+def _losses(args):
+    # Speed loss for each cell in ks, in a worker
+    n,ks,tol,maxiter=args
+    M0=_view(_shared,'M0',(n,n))
+    L=_view(_shared,'L',(n,n))
+    cin=_view(_shared,'cin',(n,))
+    cout=_view(_shared,'cout',(n,))
+    V0=_view(_shared,'V0',(n,))
+    speed=np.dot(V0,cout)
+    P=splinalg.LinearOperator((n,n),matvec=lambda r: linalg.cho_solve((L,True),np.ravel(r),check_finite=False),dtype=float)
+    out=[]
+    for k in ks:
+        m=M0[:,k].copy()
+        m[k]=0
+        def matvec(x,m=m,k=k):
+            x=np.ravel(x)
+            y=M0.dot(x)+m*(x-x[k])
+            y[k]=x[k]
+            return y
+        b=cin.copy()
+        b[k]=0
+        x0=V0.copy()
+        x0[k]=0
+        x,info=solvers.solve(splinalg.LinearOperator((n,n),matvec=matvec,dtype=float),b,method='cg',
+                             tol=tol,x0=x0,precond=P,maxiter=maxiter)
+        out.append(speed-(np.dot(x,cout)-x[k]*cout[k]))
+    return out
+
+
+class CandidatePool(object):
+    """
+    Worker processes that rank habitat cells by the exact speed lost when
+    each is removed on its own.
+
+    Args:
+    nmax: (int), Largest number of habitat cells it will be used with.
+    nproc: (int, Optional), Number of workers. Defaults to the number of CPUs.
+
+    Call close() when done.
+    """
+    def __init__(self,nmax,nproc=None):
+        if nproc is None:
+            nproc=multiprocessing.cpu_count()
+        self.nproc=nproc
+        self.buffers={'M0':sharedctypes.RawArray('d',nmax*nmax),
+                      'L':sharedctypes.RawArray('d',nmax*nmax),
+                      'cin':sharedctypes.RawArray('d',nmax),
+                      'cout':sharedctypes.RawArray('d',nmax),
+                      'V0':sharedctypes.RawArray('d',nmax)}
+        self.nmax=nmax
+        self.pool=multiprocessing.Pool(nproc,initializer=_init,initargs=(self.buffers,))
+
+    @staticmethod
+    def supports(core):
+        """
+        True if core's system can be evaluated (dense float64 M0).
+        """
+        M0=getattr(core,'M0_',None)
+        return isinstance(M0,np.ndarray) and M0.dtype==np.float64 and not core._isMixed()
+
+    def _put(self,name,a):
+        _view(self.buffers,name,a.shape)[...]=a
+
+    def speedLoss(self,core,cands,tol=1e-12,maxiter=None):
+        """
+        Speed lost by removing each candidate cell on its own.
+
+        Args:
+        core: (CondatisCore), A solved landscape with a dense M0.
+        cands: (list of ints), Habitat indices of the candidate cells.
+        tol: (number), Relative tolerance of each solve.
+        maxiter: (int, Optional), Iteration limit of each solve.
+
+        Returns:
+        1D array of speed losses, in the order of cands.
+        """
+        n=core.cin_.size
+        if not len(cands):
+            return np.empty(0)
+        if n>self.nmax:
+            raise ValueError("CandidatePool.speedLoss(): %d cells, pool was made for %d" % (n,self.nmax))
+        fac=core._factor()
+        if fac.kind!='cholesky':
+            raise ValueError("CandidatePool.speedLoss(): needs a dense M0")
+        c,lower=fac.fac_
+        self._put('M0',core.M0_)
+        self._put('L',c if lower else c.T)
+        self._put('cin',core.cin_)
+        self._put('cout',core.cout_)
+        self._put('V0',core.V0_)
+        chunks=[list(ch) for ch in np.array_split(np.asarray(cands,np.int_),min(self.nproc,len(cands))) if ch.size]
+        res=self.pool.map(_losses,[(n,ch,tol,maxiter) for ch in chunks])
+        return np.array([v for r in res for v in r])
+
+    def close(self):
+        """
+        Stop the workers.
+        """
+        self.pool.close()
+        self.pool.join()
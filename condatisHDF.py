@@ -6,7 +6,15 @@ import logging
 import numpy as np
 import numexpr as ne
 import tables
+from scipy import sparse
 import gisattribs as ga
+import hashlib
+import os
+import tempfile
+
+# Names the results stored under an input key. Change it whenever calc()
+# would give different results for the same inputs and options.
+RESULT_TAG='calc1'
 
 def makeProject(projname,title):
     h5=tables.open_file(projname,mode="w",title=title)
@@ -23,6 +31,11 @@ class CondatisCoreHDF(cc.CondatisCore):
         self.cumPowerThreshold=50.0
         self.attribs=None
         self.map_x_scale=1000.0
+        self._initOptions()
+        self.setStorage()
+        self.resultCache_=None
+        self.readCache_=None
+        self.setReadCache()
 
     @classmethod
     def fromLandscape(cls,h5,scname,land):
@@ -42,6 +55,156 @@ class CondatisCoreHDF(cc.CondatisCore):
     def map_scale(self):
         return self.map_x_scale
 
+    def setStorage(self,free='sparse',freeTol=1e-6,summaryOnly=False,complevel=4,complib='zlib'):
+        """
+        How calculation results are kept in the HDF file.
+
+        Arrays are written chunked and compressed. The N x N free-space
+        kernel (ipv_free) is by default cut down to its strong links, so
+        the file grows with N rather than N^2.
+
+        Args:
+        free: (string), What is kept of cfree: 'sparse', the links of at
+              least freeTol times the strongest as COO triplets
+              (ipv_free_i, ipv_free_j, ipv_free_v); 'dense', the whole
+              matrix as ipv_free; or 'none'.
+        freeTol: (number), Relative threshold for 'sparse'.
+        summaryOnly: (bool), Keep only the speed and total link strength
+                     attributes of a calc(), no arrays.
+        complevel: (int), Compression level, 0 for none.
+        complib: (string), Compression library (see tables.Filters).
+        """
+        if free not in ('sparse','dense','none'):
+            raise ValueError("setStorage(): unknown free storage '%s'" % free)
+        self.storeFree_=free
+        self.storeFreeTol_=freeTol
+        self.summaryOnly_=summaryOnly
+        self.filters_=tables.Filters(complevel=complevel,complib=complib,shuffle=complevel>0)
+
+    def setResultCache(self,cache):
+        """
+        Share calc() results between projects through a cache directory.
+
+        calc() always reuses the results already in this project when its
+        inputs are unchanged (see inputKey()). With a cache, results are
+        also stored there and looked up by the same key, so an identical
+        job in another project is not solved again.
+
+        Args:
+        cache: (filecache.FileCache), The cache, or None for none.
+        """
+        self.resultCache_=cache
+
+    def setReadCache(self,on=True,mmapBytes=None,directory=None):
+        """
+        Keep the arrays read by x(), y(), ap(), sx(), sy(), tx(), ty(),
+        nodeVoltage() and nodeFlow() in memory, so each node is read from
+        the file once rather than on every call. An entry is dropped when
+        its node is rewritten (_addHab(), _addSource(), _addTarget(),
+        _deleteOldCalc()) or the scenario changes.
+
+        The arrays returned are shared and read only: copy one before
+        changing it.
+
+        Args:
+        on: (bool), Cache at all.
+        mmapBytes: (int, Optional), Arrays of at least this many bytes are
+                   copied once into a temporary .npy file and memory mapped
+                   from there, so they are paged in as used rather than
+                   held. (The nodes are chunked and compressed, so can't
+                   be mapped in place.) None to hold every array.
+        directory: (string, Optional), Where to put those files. Defaults
+                   to the system temporary directory.
+        """
+        self._forget()
+        self.readCache_={} if on else None
+        self.readMmapBytes_=mmapBytes
+        self.readDir_=directory
+
+    def _read(self,name):
+        # The scenario's node name, through the read cache
+        cache=self.readCache_
+        if cache is not None and name in cache:
+            return cache[name][0]
+        node=self.scenario._f_get_child(name)
+        if cache is None:
+            return node.read()
+        path=None
+        nbytes=int(np.prod(node.shape))*node.dtype.itemsize
+        if self.readMmapBytes_ is not None and node.ndim and nbytes>=self.readMmapBytes_:
+            a,path=self._mapNode(node)
+        else:
+            a=node.read()
+            a.flags.writeable=False
+        cache[name]=(a,path)
+        return a
+
+    def _mapNode(self,node):
+        # Copy node into a temporary .npy a slab at a time and map it read
+        # only. The file is unlinked at once where the OS allows (the map
+        # stays valid); otherwise its path is returned for _forget().
+        fd,path=tempfile.mkstemp(suffix='.npy',dir=self.readDir_)
+        os.close(fd)
+        out=np.lib.format.open_memmap(path,mode='w+',dtype=node.dtype,shape=node.shape)
+        step=max(1,(1<<24)//max(1,out[:1].nbytes))
+        for s in range(0,node.shape[0],step):
+            out[s:s+step]=node.read(s,min(s+step,node.shape[0]))
+        out.flush()
+        del out
+        a=np.load(path,mmap_mode='r')
+        try:
+            os.remove(path)
+            path=None
+        except OSError:
+            pass
+        return a,path
+
+    def _forget(self,*names):
+        # Drop read cache entries, all of them if no names are given
+        cache=self.readCache_
+        if not cache:
+            return
+        for name in (names or cache.keys()):
+            a,path=cache.pop(name,(None,None))
+            if path is not None:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def inputKey(self):
+        """
+        sha1 of everything calc() depends on: the habitat, source and
+        target cells, R, dispersal, cell size and the computation options.
+        """
+        h=hashlib.sha1()
+        for a in (self.x(),self.y(),self.ap(),self.sx(),self.sy(),self.tx(),self.ty()):
+            a=np.ascontiguousarray(a,np.float64)
+            h.update(str(a.size))
+            h.update(a.data)
+        opts=(RESULT_TAG,float(self.R()),float(self.dispersal()),float(self._cell()),
+              self.sparse_,self.sparseTol_,self.solver_,self.solverTol_,str(self.precond_),
+              self.maxiter_,self.precision_,self.refineSteps_,self.refineTol_,
+              self.hier_,self.hierTol_,self.hierLeaf_,self.hierEta_,
+              self.domain_,self.domainTiles_,self.domainOverlap_)
+        h.update(repr(opts))
+        return h.hexdigest()
+
+    def _putArray(self,where,name,a):
+        # A chunked, compressed array; a plain one where that can't be
+        # (empty or scalar)
+        a=np.asarray(a)
+        if a.ndim==0 or 0 in a.shape:
+            return self.h5.create_array(where,name,a)
+        return self.h5.create_carray(where,name,obj=a,filters=self.filters_)
+
+    def _putCOO(self,where,name,i,j,v,shape):
+        # A sparse matrix as name_i, name_j, name_v
+        self._putArray(where,name+'_i',i)
+        self._putArray(where,name+'_j',j)
+        self._putArray(where,name+'_v',v)
+        setattr(where._v_attrs,name+'Shape',shape)
+
  
 
         # Access
@@ -61,49 +224,54 @@ class CondatisCoreHDF(cc.CondatisCore):
     def x(self):
         if not self.scenario.__contains__("x"):
             return np.empty(shape=0) 
-        return self.x_.read()
+        return self._read('x')
 
     def y(self):
         if not self.scenario.__contains__("y"):
             return np.empty(shape=0) 
-        return self.y_.read()
+        return self._read('y')
 
     def ap(self):
         if not self.scenario.__contains__("ap"):
             return np.empty(shape=0) 
-        return self.ap_.read()
+        return self._read('ap')
 
     def sx(self):
         if not self.scenario.__contains__("or_x"):
             return np.empty(shape=0) 
-        return self.scenario.or_x.read()
+        return self._read('or_x')
 
     def sy(self):
         if not self.scenario.__contains__("or_y"):
             return np.empty(shape=0) 
-        return self.scenario.or_y.read()
+        return self._read('or_y')
 
     def tx(self):
         if not self.scenario.__contains__("tg_x"):
             return np.empty(shape=0) 
-        return self.scenario.tg_x.read()
+        return self._read('tg_x')
 
     def ty(self):
         if not self.scenario.__contains__("tg_y"):
             return np.empty(shape=0) 
-        return self.scenario.tg_y.read()
+        return self._read('tg_y')
 
     def nodeVoltage(self):
         if not self.scenario.__contains__("V0"):
+            if isinstance(getattr(self,'V0_',None),np.ndarray):
+                # Calculated but not stored (see setStorage())
+                return self.V0_
             logging.debug("No Voltage data")
             return self.x()*0.0
-        return self.scenario.V0.read()
+        return self._read('V0')
 
     def nodeFlow(self):
         if not self.scenario.__contains__("I"):
+            if isinstance(getattr(self,'I_',None),np.ndarray):
+                return self.I_
             logging.debug("No flow data")
             return self.x()*0.0
-        return self.scenario.I.read()
+        return self._read('I')
 
     def speed(self):
         if not self.scenario._v_attrs.__contains__("I0"):
@@ -131,6 +299,7 @@ class CondatisCoreHDF(cc.CondatisCore):
         
     def makeScenario(self,name):
         h5=self.h5
+        self._forget()
         self.scenario=self.h5.create_group("/scenarios",name,"Scenario")
         gname="/scenarios/"+name
       #  h5.createGroup(gname,"input","Landscape data")
@@ -154,6 +323,7 @@ class CondatisCoreHDF(cc.CondatisCore):
         scenario=self.scenario
         scenario._v_attrs.R=R
         scenario._v_attrs.dispersal=dispersal
+        self._invalidate()
 
     def generateCombinedHabitat(self):
         scenario=self.scenario
@@ -174,19 +344,19 @@ class CondatisCoreHDF(cc.CondatisCore):
 #        don't do anything?
 #        shape=xa.shape
 #        atom=tables.Int32Atom(shape=())
-        filters = tables.Filters(complevel=0, complib='zlib')    
         if scenario.combined.__contains__('x'):
             scenario.combined.x.remove()
         if scenario.combined.__contains__('y'):
             scenario.combined.y.remove()
         if scenario.combined.__contains__('V'):
             scenario.combined.V.remove()
-        h5.create_array(scenario.combined,'x',xa)
-        h5.create_array(scenario.combined,'y',ya)
-        h5.create_array(scenario.combined,'V',xa*0)
+        self._putArray(scenario.combined,'x',xa)
+        self._putArray(scenario.combined,'y',ya)
+        self._putArray(scenario.combined,'V',xa*0)
         
     def modifyHabitat(self,land):
         self._addHab(land)
+        self._invalidate()
         
     # Adding data.
     def _addHab(self,land):
@@ -203,10 +373,11 @@ class CondatisCoreHDF(cc.CondatisCore):
 
         if scenario.__contains__('cell'):
             scenario.cell.remove()
+        self._forget('x','y','ap')
 
-        self.x_=h5.create_array(scenario,'x',land.x)
-        self.y_=h5.create_array(scenario,'y',land.y)
-        self.ap_=h5.create_array(scenario,'ap',land.v)
+        self.x_=self._putArray(scenario,'x',land.x)
+        self.y_=self._putArray(scenario,'y',land.y)
+        self.ap_=self._putArray(scenario,'ap',land.v)
         # Can I remove this?
         #h5.createArray(scenario,'cell',np.ones(land.x.size))
 
@@ -241,8 +412,10 @@ class CondatisCoreHDF(cc.CondatisCore):
             scenario.or_x.remove()
         if scenario.__contains__('or_y'):
             scenario.or_y.remove()
-        self.sx_=h5.create_array(scenario,'or_x',land.x)
-        self.sy_=h5.create_array(scenario,'or_y',land.y)
+        self._forget('or_x','or_y')
+        self.sx_=self._putArray(scenario,'or_x',land.x)
+        self.sy_=self._putArray(scenario,'or_y',land.y)
+        self._invalidate()
 
     def _addTarget(self,land):
         h5=self.h5
@@ -251,12 +424,16 @@ class CondatisCoreHDF(cc.CondatisCore):
             scenario.tg_x.remove()
         if scenario.__contains__('tg_y'):
             scenario.tg_y.remove()
-        self.tx_=h5.create_array(scenario,'tg_x',land.x)
-        self.ty_=h5.create_array(scenario,'tg_y',land.y)
+        self._forget('tg_x','tg_y')
+        self.tx_=self._putArray(scenario,'tg_x',land.x)
+        self.ty_=self._putArray(scenario,'tg_y',land.y)
+        self._invalidate()
 
     # Calculating
     def _deleteOldCalc(self):
         sc=self.scenario
+        if sc._v_attrs.__contains__('inputKey'):
+            del sc._v_attrs.inputKey
         if sc.__contains__('V0'):
             sc.V0.remove()
         if sc.__contains__('Vij'):
@@ -265,6 +442,7 @@ class CondatisCoreHDF(cc.CondatisCore):
             sc.M0.remove()
         if sc.__contains__('I'):
             sc.I.remove()
+        self._forget('V0','I')
         if sc.__contains__('I2ij'):
             sc.I2ij.remove()
         if sc.__contains__('ipv_in'):
@@ -273,23 +451,118 @@ class CondatisCoreHDF(cc.CondatisCore):
             sc.ipv_out.remove()
         if sc.__contains__('ipv_free'):
             sc.ipv_free.remove()
+        for name in ('ipv_free_i','ipv_free_j','ipv_free_v'):
+            if sc.__contains__(name):
+                sc._f_get_child(name).remove()
 
     def _saveCalc(self):
         sc=self.scenario
         h5=self.h5
-        self.V0_=h5.create_array(sc,'V0',self.V0_)
-        self.I_=h5.create_array(sc,'I',self.I_)
         sc._v_attrs.I0=self.cond_
         sc._v_attrs.totalLinkStrength=self.tls_
-        sc.cin_=h5.create_array(sc,"ipv_in",self.cin_)
-        sc.cout_=h5.create_array(sc,"ipv_out",self.cout_)
-        sc.free_=h5.create_array(sc,"ipv_free",self.cfree_)
+        if self.summaryOnly_:
+            h5.flush()
+            return
+        self.V0_=self._putArray(sc,'V0',self.V0_)
+        self.I_=self._putArray(sc,'I',self.I_)
+        sc.cin_=self._putArray(sc,"ipv_in",self.cin_)
+        sc.cout_=self._putArray(sc,"ipv_out",self.cout_)
+        self._saveFree()
         h5.flush()
 
+    def _saveFree(self):
+        # cfree as setStorage() says
+        sc=self.scenario
+        cf=self.cfree_
+        if self.storeFree_=='none':
+            return
+        if not (sparse.issparse(cf) or isinstance(cf,np.ndarray)):
+            logging.debug("_saveCalc(): cfree_ not held as a matrix, ipv_free not saved")
+            return
+        if self.storeFree_=='dense' and isinstance(cf,np.ndarray):
+            sc.free_=self._putArray(sc,"ipv_free",cf)
+            return
+        if sparse.issparse(cf):
+            c=cf.tocoo()
+            i,j,v=c.row,c.col,c.data
+        else:
+            i,j=np.nonzero(cf)
+            v=cf[i,j]
+        if self.storeFree_=='sparse' and v.size:
+            # Only the links of at least freeTol times the strongest
+            keep=v>=self.storeFreeTol_*v.max()
+            i,j,v=i[keep],j[keep],v[keep]
+            sc._v_attrs.ipv_freeTol=self.storeFreeTol_
+        self._putCOO(sc,"ipv_free",i,j,v,cf.shape)
+
     def calc(self):
+        key=self.inputKey()
+        if self._loadCalc(key):
+            return
         r=super(CondatisCoreHDF,self).calc()
         self._deleteOldCalc()
         self._saveCalc()
+        self.scenario._v_attrs.inputKey=key
+        if self.resultCache_ is not None:
+            self.resultCache_.put(key,RESULT_TAG,
+                                  {'V0':self.nodeVoltage(),'I':self.nodeFlow(),
+                                   'ipv_in':self.cin_,'ipv_out':self.cout_},
+                                  (self.cond_,self.tls_))
+
+    def _loadCalc(self,key):
+        # Take the results for these inputs from the project or the
+        # shared cache instead of solving. True if found.
+        sc=self.scenario
+        # Only if the arrays are stored: with summaryOnly there is nothing
+        # to give nodeVoltage(), nodeFlow() or calcPower()
+        if (sc._v_attrs.__contains__('inputKey') and sc._v_attrs.inputKey==key
+            and sc.__contains__('V0') and sc.__contains__('I')):
+            self.cond_=sc._v_attrs.I0
+            self.tls_=sc._v_attrs.totalLinkStrength
+            self.V0_=sc.V0
+            self.I_=sc.I
+            self._dropSystem()
+            logging.debug("calc(): inputs unchanged, results kept")
+            return True
+        if self.resultCache_ is None:
+            return False
+        res=self.resultCache_.get(key,RESULT_TAG)
+        if res is None:
+            return False
+        arrays,meta=res
+        self.putResults(arrays,meta,key)
+        logging.debug("calc(): results taken from the cache")
+        return True
+
+    def putResults(self,arrays,meta,key=None):
+        """
+        Store results computed elsewhere (the result cache, a batch
+        worker) as this scenario's calc() results.
+
+        Args:
+        arrays: (dict), 'V0', 'I', 'ipv_in' and 'ipv_out' arrays.
+        meta: (tuple), (speed,total link strength).
+        key: (string, Optional), inputKey() of the inputs they were
+             computed from. Defaults to that of the current inputs.
+        """
+        if key is None:
+            key=self.inputKey()
+        self.cond_,self.tls_=meta
+        self.V0_=arrays['V0']
+        self.I_=arrays['I']
+        self.cin_=arrays['ipv_in']
+        self.cout_=arrays['ipv_out']
+        self._dropSystem()
+        self._deleteOldCalc()
+        self._saveCalc()
+        self.scenario._v_attrs.inputKey=key
+
+    def _dropSystem(self):
+        # Results came without solving, so there is no system for them;
+        # anything that needs cfree (e.g. calcPower()) recomputes it
+        self.cfree_=None
+        self.M0_=None
+        self._invalidate()
 
     def _deleteOldPowCalc(self):
         sc=self.scenario
@@ -308,22 +581,30 @@ class CondatisCoreHDF(cc.CondatisCore):
             sc.sigy2.remove()
         if sc.__contains__('edgePower'):
             sc.edgePower.remove()
+        for name in ('edgePower_i','edgePower_j','edgePower_v'):
+            if sc.__contains__(name):
+                sc._f_get_child(name).remove()
 
         h5.flush()
 
     def _savePowCalc(self):
         sc=self.scenario
-        h5=self.h5
-        h5.create_array(sc,'edgePower',self.Pij_)
         sc._v_attrs.totalEdgePower=self.totalEdgePower
         sc._v_attrs.maxEdgePower=self.maxEdgePower
-        sc._v_attrs.edgePowerShape=self.PijU.shape
-        h5.create_array(sc,'sig_pow',self.sigpow)
-        h5.create_array(sc,'sorted_sig_power',self.pps)
-        h5.create_array(sc,'sigx1',self.sigx1)
-        h5.create_array(sc,'sigx2',self.sigx2)
-        h5.create_array(sc,'sigy1',self.sigy1)
-        h5.create_array(sc,'sigy2',self.sigy2)
+        sc._v_attrs.edgePowerShape=self.edgePowerShape
+        if self.summaryOnly_:
+            return
+        # Links above maxEdgePower/1e5 as COO triplets, not the dense matrix
+        ep=self.edgePower_
+        self._putArray(sc,'edgePower_i',ep.sigI)
+        self._putArray(sc,'edgePower_j',ep.sigJ)
+        self._putArray(sc,'edgePower_v',ep.sigP)
+        self._putArray(sc,'sig_pow',self.sigpow)
+        self._putArray(sc,'sorted_sig_power',self.pps)
+        self._putArray(sc,'sigx1',self.sigx1)
+        self._putArray(sc,'sigx2',self.sigx2)
+        self._putArray(sc,'sigy1',self.sigy1)
+        self._putArray(sc,'sigy2',self.sigy2)
 
     def hasPower(self):
         sc=self.scenario
@@ -343,6 +624,8 @@ class CondatisCoreHDF(cc.CondatisCore):
         return self.scenario._v_attrs.I0
 
     def V0(self):
+        if isinstance(self.V0_,np.ndarray):
+            return self.V0_
         return self.V0_.read()
 
     def Vij(self):
@@ -4,31 +4,149 @@ import autosourcetarget as ast
 import logging
 import numpy as np
 import numexpr as ne
+from scipy import linalg
+from scipy import sparse
+from scipy.sparse import linalg as splinalg
+import solvers
 import log_all
 
+def cellIndex(bx,by,x,y):
+    """
+    Position of each point (x,y) in the point list (bx,by), matching
+    coordinates exactly. Points that are not in the list get -1.
+    """
+    bk=bx+1j*by
+    order=np.argsort(bk)
+    sk=bk[order]
+    k=x+1j*y
+    pos=np.minimum(np.searchsorted(sk,k),max(sk.size-1,0))
+    if sk.size==0:
+        return -np.ones(k.size,np.int_)
+    return np.where(sk[pos]==k,order[pos],-1)
+
+
+class BaseKernel(object):
+    """
+    Kernel terms for a fixed set of cells, computed once per job.
+
+    The current habitat is a subset of these cells, held as an active mask.
+    Removing or restoring cells never changes the distances between the
+    others, so cin, cout and cfree for the current habitat are gathers,
+    and the cfree row sums used on the M0 diagonal are updated by
+    subtracting (or adding back) the columns of the cells that changed.
+    """
+    def __init__(self,x,y,ap,cin,cout,cfree):
+        self.x=x
+        self.y=y
+        self.ap=ap
+        self.cin=cin
+        self.cout=cout
+        self.cfree=cfree
+        self.active=np.ones(x.size,bool)
+        if sparse.issparse(cfree):
+            self.rowSum=np.asarray(cfree.sum(axis=1)).ravel()
+        else:
+            self.rowSum=cfree.sum(axis=1)
+
+    def index(self,x,y):
+        return cellIndex(self.x,self.y,x,y)
+
+    def _colSum(self,inds):
+        # cfree is symmetric, so rows stand in for columns
+        if sparse.issparse(self.cfree):
+            return np.asarray(self.cfree[inds,:].sum(axis=0)).ravel()
+        return self.cfree[inds,:].sum(axis=0)
+
+    def setActive(self,active):
+        removed=np.where(self.active & ~active)[0]
+        added=np.where(active & ~self.active)[0]
+        if removed.size:
+            self.rowSum-=self._colSum(removed)
+        if added.size:
+            self.rowSum+=self._colSum(added)
+        self.active=active
+
+    def free(self,inds):
+        if sparse.issparse(self.cfree):
+            return self.cfree[inds][:,inds]
+        return self.cfree[np.ix_(inds,inds)]
+
+
 class CondatisCoreNE(cc.CondatisCore):
     def __init__(self,land):
+        self.kernel_=None
         cc.CondatisCore.__init__(self,land)
+        self.incMaxRank_=500
+        self.incMaxIter_=30
+        self.incTol_=1e-12
 
-    def _calcCin(self):
-        x,y,sx,sy=self.x(),self.y(),self.sx(),self.sy()
-        ap=self.ap()
-        K,cell=self._K(),self._cell()
-#        logging.debug("Cell: %f" % cell)
-#        logging.debug("K: %e" % K)
-        alpha=self._alpha()
-        dm=np.sqrt((self._scind(x,cell)-self._scind(sx,cell)[:,np.newaxis])**2  + (self._scind(y,cell)-self._scind(sy,cell)[:,np.newaxis])**2)
-        self.cin_=ne.evaluate("sum(K*ap*exp(-alpha*dm),axis=0)")
+    def _invalidate(self):
+        cc.CondatisCore._invalidate(self)
+        self.incFac_=None
+        # Anything but a change of habitat (parameters, source, target,
+        # kernel options) makes the cached kernel useless
+        self.kernel_=None
 
-    def _calcCout(self):
-        x,y,tx,ty=self.x(),self.y(),self.tx(),self.ty()
-        ap=self.ap()
-        K,cell=self._K(),self._cell()
- #       logging.debug("Cell: %f" % cell)
- #       logging.debug("K: %e" % K)
-        alpha=self._alpha()
-        dm=np.sqrt((self._scind(x,cell)-self._scind(tx,cell)[:,np.newaxis])**2  + (self._scind(y,cell)-self._scind(ty,cell)[:,np.newaxis])**2)
-        self.cout_=ne.evaluate("sum(K*ap*exp(-alpha*dm),axis=0)")
+    # Cached base kernel
+
+    def cacheKernel(self):
+        """
+        Compute the kernel for the current habitat once and keep it. Later
+        habitats that are subsets of it (see modifyHabitat() and
+        removeNodes()) are then assembled by gathering from the cache
+        instead of re-evaluating distances and exponentials.
+
+        Not used in mixed precision, where the float64 residual needs the
+        kernel re-evaluated anyway, with the hierarchical kernel or with
+        domain decomposition.
+        """
+        if self._isMixed() or self._isHier() or self._isDomain():
+            logging.debug("cacheKernel(): not used in mixed precision, with the hierarchical kernel or domain decomposition")
+            return
+        if not self.inputValid_:
+            cc.CondatisCore._calcInput(self)
+            self.inputValid_=True
+        self.kernel_=BaseKernel(self.x(),self.y(),self.ap(),self.cin_,self.cout_,self.cfree_)
+        self.kidx_=np.arange(self.x().size)
+
+    def modifyHabitat(self,land):
+        kern=self.kernel_
+        cc.CondatisCore.modifyHabitat(self,land)
+        if kern is None:
+            return
+        idx=kern.index(land.x,land.y)
+        if np.all(idx>=0) and np.unique(idx).size==idx.size and np.array_equal(kern.ap[idx],land.v):
+            active=np.zeros(kern.x.size,bool)
+            active[idx]=True
+            kern.setActive(active)
+            self.kernel_=kern
+            self.kidx_=idx
+        else:
+            logging.debug("modifyHabitat(): new cells, dropping the cached kernel")
+
+    def _calcInput(self):
+        kern=self.kernel_
+        if kern is None:
+            return cc.CondatisCore._calcInput(self)
+        act=self.kidx_
+        self.cin_=kern.cin[act]
+        self.cout_=kern.cout[act]
+        self.cfree_=kern.free(act)
+        rs=kern.rowSum[act]
+        d=self.cin_+self.cout_+rs
+        if sparse.issparse(self.cfree_):
+            self.M0_=(sparse.diags(d,0,format='csr')-self.cfree_).tocsr()
+        else:
+            M0=np.negative(self.cfree_)
+            dd=np.arange(M0.shape[0])
+            M0[dd,dd]=d
+            self.M0_=M0
+        self.tls_=np.sum(rs) + np.sum(self.cin_) + np.sum(self.cout_)
+
+    def _stBlock(self,xs,ys,Kap,alpha,pxs,pys,out,tmp):
+        self._distBlock(xs,ys,pxs,pys,out,tmp)
+        # numexpr for the exponential, as in the one-shot version
+        ne.evaluate("Kap*exp(-alpha*out)",out=out)
 
     def _calcFree(self):
         x,y,ap=self.x(),self.y(),self.ap()
@@ -42,9 +160,206 @@ class CondatisCoreNE(cc.CondatisCore):
 
     # Same as CondatisCore. Reminder to re-do with NE
     def _calcM0(self):
+        if self.sparse_ or self._isMixed() or self._isHier():
+            return cc.CondatisCore._calcM0(self)
         self.M0_=cc.diag(self.cin_ + self.cout_ + self.cfree_.sum(axis=0))-self.cfree_
 
     # Same as CondatisCore. Reminder to re-do with NE
     def _calcTLS(self):
+        if self.sparse_ or self._isMixed() or self._isHier():
+            return cc.CondatisCore._calcTLS(self)
         self.tls_=np.sum(self.cfree_) + np.sum(self.cin_) + np.sum(self.cout_)
 
+
+    # Incremental node removal.
+    #
+    # removeNodes() keeps the factor of M0 from the last "refresh" (incFac_)
+    # and treats later removals as a change confined to the block of rows T
+    # that were touched: the removed cells (decoupled to identity rows) and
+    # the cells that lost links to them. Solves then use the capacitance
+    # matrix form of Sherman-Morrison-Woodbury,
+    #   (A + P D P^T)^-1 b = y - W D (I + W_T D)^-1 y_T,  y = A^-1 b, W = A^-1 P
+    # so each removal costs a few solves with the existing factor instead of
+    # a new kernel and a new factorisation.
+    #
+    # When T grows beyond incMaxRank_ (always the case with a dense kernel,
+    # where every cell is a neighbour) the current M0 is instead solved by
+    # conjugate gradient. The current M0 is the refresh-time one, A, with
+    # the removed cells R cut out and a small diagonal shift (the lost
+    # links). A restricted to the survivors S is solved exactly with the
+    # existing factor through the Schur complement,
+    #   A_SS^-1 b = (y - W W_R^-1 y_R)_S,  y = A^-1 [b;0], W = A^-1 P_R
+    # and used as the preconditioner, so only the diagonal shift is left
+    # to iterate on: a few O(N^2) iterations. The current M0 is
+    # refactorised only once they take more than incMaxIter_, or R grows
+    # beyond incMaxRank_.
+
+    def setIncremental(self,maxRank=500,maxIter=30,tol=1e-12):
+        """
+        Set how removeNodes() updates the solution.
+
+        Args:
+        maxRank: (int), Largest low-rank correction kept: touched rows
+                 before switching to conjugate gradient, removed cells
+                 before refactorising.
+        maxIter: (int), Conjugate gradient iterations above which M0 is
+                 refactorised.
+        tol: (number), Relative tolerance of those iterations.
+        """
+        self.incMaxRank_=maxRank
+        self.incMaxIter_=maxIter
+        self.incTol_=tol
+        self.incFac_=None
+
+    def _incRefresh(self):
+        self.incA_=self.M0_
+        self.incFac_=self._factor()
+        self.incN_=self.cin_.size
+        self.incIdx_=np.arange(self.incN_)
+        self.incT_=np.empty(0,np.int_)
+        self.incW_=np.empty((self.incN_,0))
+        self.incCG_=False
+        self.incR_=np.empty(0,np.int_)
+        self.incWR_=np.empty((self.incN_,0))
+
+    def _incBlock(self,T):
+        # Current M0 restricted to T, in refresh numbering. Removed cells
+        # are decoupled: identity row and column.
+        pos=-np.ones(self.incN_,np.int_)
+        pos[self.incIdx_]=np.arange(self.incIdx_.size)
+        p=pos[T]
+        act=p>=0
+        B=np.identity(T.size)
+        pa=p[act]
+        if sparse.issparse(self.M0_):
+            B[np.ix_(act,act)]=self.M0_[pa][:,pa].toarray()
+        else:
+            B[np.ix_(act,act)]=self.M0_[np.ix_(pa,pa)]
+        return B
+
+    def _incSolve(self,b):
+        bf=np.zeros(self.incN_)
+        bf[self.incIdx_]=b
+        y=self.incFac_.solve(bf)
+        T=self.incT_
+        if T.size:
+            A=self.incA_
+            if sparse.issparse(A):
+                ATT=A[T][:,T].toarray()
+            else:
+                ATT=A[np.ix_(T,T)]
+            D=self._incBlock(T)-ATT
+            cap=np.identity(T.size)+self.incW_[T,:].dot(D)
+            y=y-self.incW_.dot(D.dot(np.linalg.solve(cap,y[T])))
+        return y[self.incIdx_]
+
+    def _incIterate(self,x0):
+        # Conjugate gradient on the current M0 (see the notes above). x0 is
+        # a starting guess.
+        idx=self.incIdx_
+        N=self.incN_
+        gone=np.ones(N,bool)
+        gone[idx]=False
+        new=np.setdiff1d(np.where(gone)[0],self.incR_)
+        if self.incR_.size+new.size > self.incMaxRank_:
+            self._incRefresh()
+            self.solveInfo_=solvers.SolveInfo('direct')
+            return self.incFac_.solve(self.cin_)
+        if new.size:
+            E=np.zeros((N,new.size))
+            E[new,np.arange(new.size)]=1.0
+            self.incWR_=np.hstack((self.incWR_,self.incFac_.solve(E)))
+            self.incR_=np.concatenate((self.incR_,new))
+        R=self.incR_
+        W=self.incWR_
+        lu=linalg.lu_factor(W[R,:]) if R.size else None
+        def precond(r):
+            bf=np.zeros(N)
+            bf[idx]=np.ravel(r)
+            y=self.incFac_.solve(bf)
+            if lu is not None:
+                y-=W.dot(linalg.lu_solve(lu,y[R]))
+            return y[idx]
+        n=idx.size
+        x,self.solveInfo_=solvers.solve(self.M0_,self.cin_,method='cg',tol=self.incTol_,x0=x0,
+                                        precond=splinalg.LinearOperator((n,n),matvec=precond,dtype=float))
+        if self.solveInfo_.iterations>self.incMaxIter_:
+            logging.debug("removeNodes(): %d iterations, refactorising M0" % self.solveInfo_.iterations)
+            self._incRefresh()
+        return x
+
+    def removeNodes(self,inds):
+        """
+        Remove habitat cells and refresh V0, node flow and speed.
+
+        The kernel is not recomputed: cin, cout and cfree are cut down to
+        the surviving cells, M0 is adjusted for the lost links, and the
+        flow is re-solved with a low-rank update of the existing factor
+        or conjugate gradient preconditioned by it (see the notes above).
+        Falls back to a full calc() if the system has not been assembled
+        yet, in mixed precision or with the hierarchical kernel.
+
+        Args:
+        inds: (int or array of ints), Indices of the cells to remove.
+        """
+        inds=np.unique(np.atleast_1d(inds))
+        # The float32 kernel needs its float64 refinement, and the
+        # hierarchical kernel has no entries to cut down, so both take
+        # the full path
+        if not self.inputValid_ or self._isMixed() or self._isHier():
+            self.modifyHabitat(self.habitatL().delete(inds))
+            self.calc()
+            return
+        if self.incFac_ is None:
+            self._incRefresh()
+
+        n=self.cin_.size
+        keep=np.ones(n,bool)
+        keep[inds]=False
+        cf=self.cfree_
+        # Conductance every cell loses to the removed ones (cfree is symmetric)
+        if sparse.issparse(cf):
+            lost=np.asarray(cf[inds,:].sum(axis=0)).ravel()
+        else:
+            lost=cf[inds,:].sum(axis=0)
+        touched=np.union1d(inds,np.where(lost!=0)[0])
+
+        self.tls_-=2.0*np.sum(lost)-np.sum(lost[inds])+np.sum(self.cin_[inds])+np.sum(self.cout_[inds])
+        if self.kernel_ is not None:
+            active=self.kernel_.active.copy()
+            active[self.kidx_[inds]]=False
+            self.kernel_.setActive(active)
+            self.kidx_=self.kidx_[keep]
+        self.x_=self.x()[keep]
+        self.y_=self.y()[keep]
+        self.ap_=self.ap()[keep]
+        self.cin_=self.cin_[keep]
+        self.cout_=self.cout_[keep]
+        if sparse.issparse(cf):
+            self.cfree_=cf[keep][:,keep]
+            self.M0_=(self.M0_[keep][:,keep]-sparse.diags(lost[keep],0)).tocsr()
+        else:
+            self.cfree_=cf[np.ix_(keep,keep)]
+            M0=self.M0_[np.ix_(keep,keep)]
+            dd=np.arange(M0.shape[0])
+            M0[dd,dd]-=lost[keep]
+            self.M0_=M0
+        self.fac_=None
+
+        ref=self.incIdx_
+        new=np.setdiff1d(ref[touched],self.incT_)
+        self.incIdx_=ref[keep]
+        if not self.incCG_ and self.incT_.size+new.size > min(self.incMaxRank_,self.incN_/4):
+            self.incCG_=True
+        if self.incCG_:
+            # Start from the last voltages
+            V0=getattr(self,'V0_',None)
+            x0=V0[keep] if isinstance(V0,np.ndarray) and V0.size==n else None
+            self._flowFromV(self._incIterate(x0))
+            return
+        if new.size:
+            E=np.zeros((self.incN_,new.size))
+            E[new,np.arange(new.size)]=1.0
+            self.incW_=np.hstack((self.incW_,self.incFac_.solve(E)))
+            self.incT_=np.concatenate((self.incT_,new))
+        self._flowFromV(self._incSolve(self.cin_))
@@ -1,10 +1,17 @@
 import scipy as sp
 from scipy import linalg
+from scipy import sparse
+from scipy.sparse import linalg as splinalg
+from scipy.spatial import cKDTree
 import pandas as pd
 import numpy as np
 import numexpr as ne
 import landscape as ls
 import autosourcetarget as ast
+import solvers
+import hkernel
+import domaindecomp
+import tablewriter
 import logging
 
 
@@ -23,6 +30,141 @@ def topNinds_(full,N=10):
     xl, yl = np.unravel_index(indices, full.shape)
     return xl,yl
     
+class EdgePower(object):
+    """
+    Running summary of link powers, fed a block at a time.
+
+    Keeps the total and maximum power, the N strongest links and every
+    link above maximum/ratio, without holding the full power matrix.
+    Links only ever need dropping from the thresholded list when the
+    running maximum rises, so the list is pruned as the sweep goes.
+
+    After finish():
+    total, max: (numbers), Total and maximum link power.
+    topI, topJ, topP: (1D arrays), End points and power of the N strongest links.
+    sigI, sigJ, sigP: (1D arrays), End points and power of links above max/ratio.
+    """
+    def __init__(self,N=1000,ratio=100000.0):
+        self.N=N
+        self.ratio=ratio
+        self.total=0.0
+        self.max=0.0
+        self.topI=np.empty(0,np.int_)
+        self.topJ=np.empty(0,np.int_)
+        self.topP=np.empty(0)
+        self.sigI=np.empty(0,np.int_)
+        self.sigJ=np.empty(0,np.int_)
+        self.sigP=np.empty(0)
+        self.pending_=[]
+        self.npending_=0
+
+    def _top(self,i,j,p):
+        i=np.concatenate((self.topI,i))
+        j=np.concatenate((self.topJ,j))
+        p=np.concatenate((self.topP,p))
+        if p.size>self.N:
+            k=np.argpartition(-p,self.N)[:self.N]
+            i,j,p=i[k],j[k],p[k]
+        self.topI,self.topJ,self.topP=i,j,p
+
+    def _prune(self):
+        t=self.max/self.ratio
+        parts=[(self.sigI,self.sigJ,self.sigP)]+self.pending_
+        i=np.concatenate([q[0] for q in parts])
+        j=np.concatenate([q[1] for q in parts])
+        p=np.concatenate([q[2] for q in parts])
+        keep=p>t
+        self.sigI,self.sigJ,self.sigP=i[keep],j[keep],p[keep]
+        self.pending_=[]
+        self.npending_=0
+
+    def add(self,i,j,p):
+        """
+        Add the links (i[k],j[k]) with powers p[k].
+        """
+        if p.size==0:
+            return
+        self.total+=np.sum(p)
+        self.max=max(self.max,np.max(p))
+        pos=p>0
+        if p.size>self.N:
+            k=np.argpartition(-p,self.N)[:self.N]
+            k=k[pos[k]]
+        else:
+            k=np.where(pos)[0]
+        self._top(i[k],j[k],p[k])
+        w=np.where(p>self.max/self.ratio)[0]
+        self.pending_.append((i[w],j[w],p[w]))
+        self.npending_+=w.size
+        if self.npending_>self.sigP.size+self.N:
+            self._prune()
+
+    def addBlock(self,r0,P):
+        """
+        Add a dense block of powers P whose first row is link row r0.
+        Entries that are not links should be zero.
+        """
+        if P.size==0:
+            return
+        self.total+=np.sum(P)
+        self.max=max(self.max,np.max(P))
+        ncol=P.shape[1]
+        flat=P.ravel()
+        if flat.size>self.N:
+            k=np.argpartition(-flat,self.N)[:self.N]
+        else:
+            k=np.arange(flat.size)
+        k=k[flat[k]>0]
+        self._top(r0+k//ncol,k%ncol,flat[k])
+        w=np.nonzero(P>self.max/self.ratio)
+        self.pending_.append((r0+w[0],w[1],P[w]))
+        self.npending_+=w[0].size
+        if self.npending_>self.sigP.size+self.N:
+            self._prune()
+
+    def finish(self):
+        self._prune()
+
+
+class MultiresInfo(object):
+    """
+    Diagnostics from a coarse-to-fine solve (CondatisCore.calcMultires()).
+
+    Attributes:
+    factor: (int), Cells per side merged into one coarse cell.
+    coarseN: (int), Number of coarse cells.
+    coarseSpeed: (number), Speed of the coarse problem.
+    coarserSpeed: (number), Speed with blocks of 2*factor.
+    estimate: (number), Relative change in speed between the two coarse
+              levels, a (usually pessimistic) estimate of the coarse
+              level's own error.
+    accepted: (bool), True if the coarse answer was used as the result.
+    error: (number), Relative difference between the coarse and full
+           resolution speeds (None if the fine level wasn't solved).
+    solve: (SolveInfo), The fine level solve (None if not solved).
+    """
+    def __init__(self,factor):
+        self.factor=factor
+        self.coarseN=0
+        self.coarseSpeed=0.0
+        self.coarserSpeed=0.0
+        self.estimate=0.0
+        self.accepted=False
+        self.error=None
+        self.solve=None
+
+    def __repr__(self):
+        s="Multiresolution Info:\n"
+        s+="Factor: %d" % self.factor + '\n'
+        s+="Coarse cells: %d" % self.coarseN + '\n'
+        s+="Coarse speed: %e" % self.coarseSpeed + '\n'
+        s+="Estimated coarse error: %e" % self.estimate + '\n'
+        s+="Accepted: %s" % self.accepted
+        if self.error is not None:
+            s+='\n' + "Coarse error: %e" % self.error
+        return s
+
+
 class CondatisCore(object):
 
     map_scale_constant = 1.0
@@ -58,6 +200,37 @@ class CondatisCore(object):
         self.cfree_=np.empty((0))
 
         self.cumPowerThreshold=50.0
+        self._initOptions()
+
+    def _initOptions(self):
+        # Computation options. Subclasses that don't call
+        # CondatisCore.__init__ (e.g. CondatisCoreHDF) call this directly.
+        self.sparse_=False
+        self.sparseTol_=1e-12
+        self.solver_='direct'
+        self.solverTol_=1e-8
+        self.precond_='jacobi'
+        self.maxiter_=None
+        self.solveInfo_=None
+        self.multiresInfo_=None
+        self.blockBytes_=64*2**20
+        self.precision_='double'
+        self.refineSteps_=10
+        self.refineTol_=1e-12
+        self.hier_=False
+        self.hierTol_=1e-6
+        self.hierLeaf_=128
+        self.hierEta_=1.0
+        self.domain_=False
+        self.domainTiles_=None
+        self.domainOverlap_=1.0
+        self._invalidate()
+
+    def _invalidate(self):
+        # Forget the assembled system and its factor. Called whenever the
+        # habitat, source, target or parameters change.
+        self.inputValid_=False
+        self.fac_=None
 
     # Access
     def R(self):
@@ -136,17 +309,161 @@ class CondatisCore(object):
     def setParams(self,R,disp):
         self.R_=R
         self.dispersal_=disp
+        self._invalidate()
+
+    def setSparse(self,on=True,tol=1e-12):
+        """
+        Switch the free-space conductances to a truncated sparse form.
+
+        Only links with exp(-alpha*d) > tol are kept, found with a
+        neighbour search, and cfree_/M0_ are stored as scipy sparse
+        matrices. Memory then grows with N*neighbours rather than N^2.
+
+        Args:
+        on: (bool), Use the sparse kernel.
+        tol: (number), Smallest exp(-alpha*d) kept as a link.
+        """
+        self.sparse_=on
+        self.sparseTol_=tol
+        self._invalidate()
+
+    def isSparse(self):
+        return self.sparse_
+
+    def setSolver(self,method='direct',tol=1e-8,precond='jacobi',maxiter=None):
+        """
+        Choose how the M0 system is solved. See solvers.solve().
+
+        Args:
+        method: (string), 'direct' or 'cg'.
+        tol: (number), Relative tolerance for 'cg'.
+        precond: (string), 'none', 'jacobi', 'ilu' or 'amg' (needs pyamg).
+        maxiter: (int, Optional), Iteration limit for 'cg'.
+        """
+        if method not in solvers.METHODS:
+            raise ValueError("setSolver(): unknown method '%s'" % method)
+        if precond not in solvers.PRECONDITIONERS:
+            raise ValueError("setSolver(): unknown preconditioner '%s'" % precond)
+        self.solver_=method
+        self.solverTol_=tol
+        self.precond_=precond
+        self.maxiter_=maxiter
+
+    def setPrecision(self,mode='double',steps=10,tol=1e-12):
+        """
+        Choose the precision of the dense kernel and its factorisation.
+
+        In 'mixed' mode cfree_ and M0_ are built and factorised in float32,
+        halving their memory. V0 is then brought to float64 accuracy by
+        iterative refinement against the float64 residual, which is
+        computed by re-evaluating the kernel block by block. The achieved
+        residual is reported through solveInfo(). The sparse kernel always
+        runs in float64.
+
+        Args:
+        mode: (string), 'double' or 'mixed'.
+        steps: (int), Maximum refinement steps.
+        tol: (number), Target relative residual |cin-M0 V0|/|cin|.
+        """
+        if mode not in ('double','mixed'):
+            raise ValueError("setPrecision(): unknown mode '%s'" % mode)
+        self.precision_=mode
+        self.refineSteps_=steps
+        self.refineTol_=tol
+        self._invalidate()
+
+    def _isMixed(self):
+        return self.precision_=='mixed' and not self.sparse_ and not self._isHier()
+
+    def setHierarchical(self,on=True,tol=1e-6,leafSize=128,eta=1.0):
+        """
+        Replace the dense free-space kernel with a hierarchical
+        approximation (see hkernel.HKernel).
+
+        cfree_ is then an operator rather than a matrix: well separated
+        groups of cells interact through low rank blocks accurate to tol,
+        products with it cost about N*log(N), and M0 is solved by
+        conjugate gradient with a Jacobi preconditioner (tolerance and
+        iteration limit from setSolver()). For long dispersal distances,
+        where the sparse kernel stays nearly dense. Ignored while the
+        sparse kernel is on.
+
+        Args:
+        on: (bool), Use the hierarchical kernel.
+        tol: (number), Relative accuracy of the low rank blocks.
+        leafSize: (int), Largest number of cells in a quadtree leaf.
+        eta: (number), Clusters whose size is at most eta times their
+             separation are approximated.
+        """
+        self.hier_=on
+        self.hierTol_=tol
+        self.hierLeaf_=leafSize
+        self.hierEta_=eta
+        self._invalidate()
+
+    def _isHier(self):
+        return self.hier_ and not self.sparse_
+
+    def setDomainDecomposition(self,on=True,ntiles=None,overlap=1.0):
+        """
+        Solve in parallel over overlapping tiles (see domaindecomp).
+
+        calc() then starts one worker process per tile. Each holds its
+        tile's rows of cfree (dense, or truncated when the sparse kernel
+        is on), and M0 is solved by conjugate gradient with an additive
+        Schwarz preconditioner built from the tiles' local solves, to the
+        tolerance set by setSolver(). The kernel is never held whole, so
+        cfree_ and M0_ are not kept.
+
+        Args:
+        on: (bool), Use domain decomposition.
+        ntiles: (int, Optional), Number of tiles (processes). Defaults to
+                the number of CPUs.
+        overlap: (number), Subdomain overlap, in kernel lengths 1/alpha.
+                 Tiles are never narrower than the overlap.
+        """
+        self.domain_=on
+        self.domainTiles_=ntiles
+        self.domainOverlap_=overlap
+        self._invalidate()
+
+    def _isDomain(self):
+        return self.domain_
+
+    def setMemoryBudget(self,nbytes):
+        """
+        Limit the size of the temporaries used when the kernel is streamed
+        in blocks (cin/cout assembly, mixed precision residuals).
+
+        Args:
+        nbytes: (int), Approximate bytes allowed for block temporaries.
+        """
+        self.blockBytes_=nbytes
+
+    def solveInfo(self):
+        """
+        SolveInfo (iterations, residual) from the last flow solve.
+        """
+        return self.solveInfo_
+
+    def multiresInfo(self):
+        """
+        MultiresInfo from the last calcMultires().
+        """
+        return self.multiresInfo_
     
     def modifyHabitat(self,land):
         self.x_=land.x
         self.y_=land.y
         self.ap_=land.v
+        self._invalidate()
 
         
     # Source and Target
     def _addSource(self,land):
         self.sx_=land.x
         self.sy_=land.y
+        self._invalidate()
 
     def addSource(self,land):
      #   land.removeDuplicates(self.habitatL())
@@ -158,6 +475,7 @@ class CondatisCore(object):
     def _addTarget(self,land):
         self.tx_=land.x
         self.ty_=land.y
+        self._invalidate()
 
     def addTarget(self,land):
         temp = self.habitatL()
@@ -183,43 +501,80 @@ class CondatisCore(object):
     def _scind(self,v,cell):
         return (v+.5)*self._cell()
 
-    def _calcCin(self):
-        x,y,sx,sy=self.x(),self.y(),self.sx(),self.sy()
-        ap=self.ap()
+    def _blockRows(self,ncols,arrays=2):
+        # Rows per block so that `arrays` float64 blocks of ncols fit the budget
+        return max(1,int(self.blockBytes_/(8*max(ncols,1)*arrays)))
+
+    def _distBlock(self,xs,ys,pxs,pys,out,tmp):
+        # Distances between the points (pxs,pys) and the scaled habitat
+        # (xs,ys), written into out
+        np.subtract(xs,pxs[:,np.newaxis],out=out)
+        np.square(out,out=out)
+        np.subtract(ys,pys[:,np.newaxis],out=tmp)
+        np.square(tmp,out=tmp)
+        np.add(out,tmp,out=out)
+        np.sqrt(out,out=out)
+
+    def _stBlock(self,xs,ys,Kap,alpha,pxs,pys,out,tmp):
+        # K*ap*exp(-alpha*d) between the points (pxs,pys) and the scaled
+        # habitat (xs,ys), written into out. Same operations, in the same
+        # order, as the one-shot expression it replaces.
+        self._distBlock(xs,ys,pxs,pys,out,tmp)
+        np.multiply(-alpha,out,out=out)
+        np.exp(out,out=out)
+        np.multiply(Kap,out,out=out)
+
+    def _stScaled(self,px,py):
+        x,y,ap=self.x(),self.y(),self.ap()
         K,cell=self._K(),self._cell()
-        logging.debug("Cell: %f" % cell)
-#        logging.debug("K: %e" % K)
-        alpha=self._alpha()
-        dm=np.sqrt((self._scind(x,cell)-self._scind(sx,cell)[:,np.newaxis])**2  + (self._scind(y,cell)-self._scind(sy,cell)[:,np.newaxis])**2)
-        self.cin_=np.sum(K*ap*np.exp(-alpha*dm),axis=0)
+        xs,ys=self._scind(x,cell),self._scind(y,cell)
+        return xs,ys,K*ap,self._alpha(),self._scind(px,cell),self._scind(py,cell)
+
+    def _stSum(self,px,py):
+        # Column sums of the kernel between the points (px,py) and the
+        # habitat, streamed over blocks of points. The running total rides
+        # in row 0 of each block so the additions happen in exactly the
+        # order of a single np.sum(...,axis=0) over all the points.
+        xs,ys,Kap,alpha,pxs,pys=self._stScaled(px,py)
+        n,m=xs.size,pxs.size
+        b=min(self._blockRows(n),max(m,1))
+        buf=np.empty((b+1,n))
+        tmp=np.empty((b,n))
+        acc=np.zeros(n)
+        for r0 in range(0,m,b):
+            r1=min(r0+b,m)
+            k=r1-r0
+            self._stBlock(xs,ys,Kap,alpha,pxs[r0:r1],pys[r0:r1],buf[1:k+1],tmp[:k])
+            buf[0]=acc
+            acc=np.sum(buf[:k+1],axis=0)
+        return acc
+
+    def _stAll(self,px,py):
+        # Full points x habitat kernel, filled block by block so that only
+        # one block of temporaries exists besides the result.
+        xs,ys,Kap,alpha,pxs,pys=self._stScaled(px,py)
+        n,m=xs.size,pxs.size
+        b=min(self._blockRows(n,1),max(m,1))
+        out=np.empty((m,n))
+        tmp=np.empty((b,n))
+        for r0 in range(0,m,b):
+            r1=min(r0+b,m)
+            self._stBlock(xs,ys,Kap,alpha,pxs[r0:r1],pys[r0:r1],out[r0:r1],tmp[:r1-r0])
+        return out
+
+    def _calcCin(self):
+        logging.debug("Cell: %f" % self._cell())
+        self.cin_=self._stSum(self.sx(),self.sy())
 
-                
     def _calcCout(self):
-        x,y,tx,ty=self.x(),self.y(),self.tx(),self.ty()
-        ap=self.ap()
-        K,cell=self._K(),self._cell()
-        alpha=self._alpha()
-        dm=np.sqrt((self._scind(x,cell)-self._scind(tx,cell)[:,np.newaxis])**2  + (self._scind(y,cell)-self._scind(ty,cell)[:,np.newaxis])**2)
-        self.cout_=np.sum(K*ap*np.exp(-alpha*dm),axis=0)
-        
+        self.cout_=self._stSum(self.tx(),self.ty())
+
     def _cinAll(self):
-        x,y,sx,sy=self.x(),self.y(),self.sx(),self.sy()
-        ap=self.ap()
-        K,cell=self._K(),self._cell()
-        logging.debug("Cell: %f" % cell)
-#        logging.debug("K: %e" % K)
-        alpha=self._alpha()
-        dm=np.sqrt((self._scind(x,cell)-self._scind(sx,cell)[:,np.newaxis])**2  + (self._scind(y,cell)-self._scind(sy,cell)[:,np.newaxis])**2)
-        return K*ap*np.exp(-alpha*dm)
-        
+        return self._stAll(self.sx(),self.sy())
+
     def _coutAll(self):
-        x,y,tx,ty=self.x(),self.y(),self.tx(),self.ty()
-        ap=self.ap()
-        K,cell=self._K(),self._cell()
-        alpha=self._alpha()
-        dm=np.sqrt((self._scind(x,cell)-self._scind(tx,cell)[:,np.newaxis])**2  + (self._scind(y,cell)-self._scind(ty,cell)[:,np.newaxis])**2)
-        return K*ap*np.exp(-alpha*dm)
-        
+        return self._stAll(self.tx(),self.ty())
+
     def _calcFree(self):
         x,y,ap=self.x(),self.y(),self.ap()
         K,cell=self._K(),self._cell()
@@ -229,30 +584,227 @@ class CondatisCore(object):
         self.cfree_=K*ap*apt*np.exp(-alpha*dm)
         dd=np.arange(self.cfree_.shape[0])
         self.cfree_[dd,dd]=0
-        
+
+    def _freeRows(self):
+        # Yield (r0,r1,blk) with blk rows r0:r1 of the float64 free-space
+        # kernel, recomputed block by block. blk is a reused buffer, so
+        # consumers must copy anything they keep.
+        x,y,ap=self.x(),self.y(),self.ap()
+        xs,ys,Kap,alpha,_,_=self._stScaled(x,y)
+        n=x.size
+        b=min(self._blockRows(n),max(n,1))
+        out=np.empty((b,n))
+        tmp=np.empty((b,n))
+        for r0 in range(0,n,b):
+            r1=min(r0+b,n)
+            k=r1-r0
+            blk=out[:k]
+            self._stBlock(xs,ys,Kap,alpha,xs[r0:r1],ys[r0:r1],blk,tmp[:k])
+            blk*=ap[r0:r1,np.newaxis]
+            blk[np.arange(k),np.arange(r0,r1)]=0
+            yield r0,r1,blk
+
+    def _calcFreeMixed(self):
+        # float32 kernel, with exact float64 row sums kept for M0 and the residual
+        n=self.x().size
+        cf=np.empty((n,n),np.float32)
+        fs=np.empty(n)
+        for r0,r1,blk in self._freeRows():
+            cf[r0:r1]=blk
+            fs[r0:r1]=np.sum(blk,axis=1)
+        self.cfree_=cf
+        self.freeSum_=fs
+
+    def _M0dot(self,v):
+        # float64 M0*v without storing the float64 kernel; v may have a
+        # column per right hand side
+        d=self.cin_+self.cout_+self.freeSum_
+        w=(d[:,np.newaxis] if np.ndim(v)==2 else d)*v
+        for r0,r1,blk in self._freeRows():
+            w[r0:r1]-=blk.dot(v)
+        return w
+
+    def _kernelRadius(self):
+        # Distance beyond which exp(-alpha*d) drops below the sparse tolerance
+        return -np.log(self.sparseTol_)/self._alpha()
+
+    def _calcFreeSparse(self):
+        x,y,ap=self.x(),self.y(),self.ap()
+        K,cell=self._K(),self._cell()
+        alpha=self._alpha()
+        n=x.size
+        pts=np.column_stack((self._scind(x,cell),self._scind(y,cell)))
+        pairs=cKDTree(pts).query_pairs(self._kernelRadius(),output_type='ndarray')
+        i,j=pairs[:,0],pairs[:,1]
+        d=np.sqrt(np.sum((pts[i]-pts[j])**2,axis=1))
+        c=K*ap[i]*ap[j]*np.exp(-alpha*d)
+        rows=np.concatenate((i,j))
+        cols=np.concatenate((j,i))
+        self.cfree_=sparse.coo_matrix((np.concatenate((c,c)),(rows,cols)),shape=(n,n)).tocsr()
+        logging.debug("Sparse cfree: %d links, %d nodes" % (c.size,n))
+
+    def _calcFreeHier(self):
+        x,y,ap=self.x(),self.y(),self.ap()
+        K,cell=self._K(),self._cell()
+        self.cfree_=hkernel.HKernel(self._scind(x,cell),self._scind(y,cell),ap,self._alpha(),scale=K,
+                                    tol=self.hierTol_,leafSize=self.hierLeaf_,eta=self.hierEta_)
+
+    def _freeSum(self):
+        # Column sums of cfree_, for any storage
+        if self._isMixed():
+            return self.freeSum_
+        if isinstance(self.cfree_,hkernel.HKernel):
+            return self.cfree_.rowSum()
+        if sparse.issparse(self.cfree_):
+            return np.asarray(self.cfree_.sum(axis=0)).ravel()
+        return self.cfree_.sum(axis=0)
+
     def _calcM0(self):
+        if sparse.issparse(self.cfree_):
+            d=self.cin_ + self.cout_ + self._freeSum()
+            self.M0_=(sparse.diags(d,0,format='csr')-self.cfree_).tocsr()
+            return
+        if isinstance(self.cfree_,hkernel.HKernel):
+            self.M0diag_=self.cin_ + self.cout_ + self._freeSum()
+            self.M0_=self.cfree_.system(self.M0diag_)
+            return
+        if self._isMixed():
+            M0=np.negative(self.cfree_)
+            dd=np.arange(M0.shape[0])
+            M0[dd,dd]=self.cin_ + self.cout_ + self.freeSum_
+            self.M0_=M0
+            return
         self.M0_=diag(self.cin_ + self.cout_ + self.cfree_.sum(axis=0))-self.cfree_
 
     def _calcTLS(self):
+        if self._isMixed() or self._isHier():
+            self.tls_=np.sum(self._freeSum()) + np.sum(self.cin_) + np.sum(self.cout_)
+            return
         self.tls_=np.sum(self.cfree_) + np.sum(self.cin_) + np.sum(self.cout_)
         
     def _calcInput(self):
         self._calcCin()
         self._calcCout()
-        self._calcFree()
+        if self.sparse_:
+            self._calcFreeSparse()
+        elif self._isHier():
+            self._calcFreeHier()
+        elif self._isMixed():
+            self._calcFreeMixed()
+        else:
+            self._calcFree()
         self._calcM0()
         self._calcTLS()
                         
+    def _initialGuess(self):
+        # Warm start iterative solves from the last voltages if they still fit
+        V0=getattr(self,'V0_',None)
+        if isinstance(V0,np.ndarray) and V0.shape==self.cin_.shape:
+            return V0
+        return None
+
+    def _factor(self):
+        # Factorise M0 once and keep it until the inputs change
+        if self.fac_ is None:
+            self.fac_=solvers.factor(self.M0_)
+            logging.debug("M0 factorised (%s)" % self.fac_.kind)
+        return self.fac_
+
+    def _solveMixed(self,b):
+        # float32 factor solves, refined against the float64 residual. Each
+        # correction is solved on the normalised residual so tiny values
+        # don't underflow in float32. A 2D b is normalised column by column.
+        info=solvers.SolveInfo('mixed')
+        try:
+            fac=self._factor()
+        except linalg.LinAlgError:
+            logging.warning("float32 Cholesky failed, factorising M0 in float64")
+            self.fac_=solvers.factor(self.M0_.astype(np.float64))
+            fac=self.fac_
+        nb=np.linalg.norm(b,axis=0)
+        nb=np.where(nb==0,1.0,nb)
+        x=nb*fac.solve((b/nb).astype(np.float32)).astype(np.float64)
+        steps=0
+        while True:
+            r=b-self._M0dot(x)
+            nr=np.linalg.norm(r,axis=0)
+            info.residual=np.max(nr/nb)
+            if info.residual<=self.refineTol_ or steps>=self.refineSteps_:
+                break
+            nr=np.where(nr==0,1.0,nr)
+            x+=nr*fac.solve((r/nr).astype(np.float32))
+            steps+=1
+        info.iterations=steps
+        info.converged=info.residual<=self.refineTol_
+        if not info.converged:
+            logging.warning("Mixed precision refinement stopped at residual %e" % info.residual)
+        self.solveInfo_=info
+        return x
+
+    def _solveM0(self,b,x0=None):
+        if self._isMixed():
+            return self._solveMixed(b)
+        if np.ndim(b)==2 and (self._isHier() or self.solver_!='direct'):
+            # cg takes one right hand side at a time
+            x=np.empty(b.shape)
+            for k in range(b.shape[1]):
+                x[:,k]=self._solveM0(b[:,k],None if x0 is None else x0[:,k])
+            return x
+        if self._isHier():
+            # Only products with M0 are available, so always iterate
+            P=None
+            if self.precond_!='none':
+                P=solvers.jacobi(self.M0_,self.M0diag_)
+            x,self.solveInfo_=solvers.solve(self.M0_,b,method='cg',tol=self.solverTol_,
+                                             x0=x0,precond=P,maxiter=self.maxiter_)
+            return x
+        fac=None
+        if self.solver_=='direct':
+            fac=self._factor()
+        x,self.solveInfo_=solvers.solve(self.M0_,b,method=self.solver_,tol=self.solverTol_,
+                                         x0=x0,precond=self.precond_,maxiter=self.maxiter_,fac=fac)
+        return x
+
+    def solveM0(self,b):
+        """
+        Solve M0 x = b against the current landscape, e.g. for sensitivity
+        right hand sides. Reuses the cached factor of M0 where possible.
+
+        Args:
+        b: (1D or 2D numpy array), Right hand side(s), one row per habitat cell.
+
+        Returns:
+        The solution x, same shape as b.
+        """
+        if not self.inputValid_:
+            self._calcInput()
+            self.inputValid_=True
+        return self._solveM0(b)
+
     def _calcFlow(self):
-        V0 = np.linalg.solve(self.M0_,self.cin_)
-        I0 = np.sum(V0*self.cout_)
+        V0 = self._solveM0(self.cin_,self._initialGuess())
+        self._flowFromV(V0)
+
+    def _freeFlow(self,V0,cfree=None):
+        # Half the absolute current through each node's free-space links
+        if cfree is None:
+            cfree=self.cfree_
+        if isinstance(cfree,hkernel.HKernel):
+            return cfree.absFlow(V0)/2.0
+        if sparse.issparse(cfree):
+            c=cfree.tocoo()
+            cur=np.abs(c.data*(V0[c.col]-V0[c.row]))
+            return np.bincount(c.col,weights=cur,minlength=V0.size)/2.0
+        cur=cfree*(V0-V0[:,np.newaxis])
+        return np.sum(np.abs(cur)/2.0,axis=0)
+
+    def _flowFromV(self,V0,flo=None):
         Iout=V0*self.cout_
         Iin=(1-V0)*self.cin_
         self.Iin_=Iin
         self.Iout_=Iout
         self.cond_=np.sum(Iout)
-        cur=self.cfree_*(V0-V0[:,np.newaxis])
-        self.flo_=np.sum(np.abs(cur)/2.0,axis=0)
+        self.flo_=self._freeFlow(V0) if flo is None else flo
         self.I_=self.flo_+Iout+Iin
         self.V0_=V0
         
@@ -380,38 +932,56 @@ class CondatisCore(object):
         self.pps=self.hpps
         
         
+    def _cfreeRows(self):
+        # Yield (r0,r1,blk) row blocks of the free-space conductances,
+        # whatever form cfree_ is held in
+        cf=self.cfree_
+        if not isinstance(cf,np.ndarray) and not sparse.issparse(cf):
+            for r in self._freeRows():
+                yield r
+            return
+        n=cf.shape[0]
+        b=min(self._blockRows(n,3),max(n,1))
+        for r0 in range(0,n,b):
+            r1=min(r0+b,n)
+            if sparse.issparse(cf):
+                yield r0,r1,cf[r0:r1].toarray()
+            else:
+                yield r0,r1,cf[r0:r1]
+
     def _calcHabLinks(self):
-        print "_clacHabLinks()"
-        V0=self.V0()
-        self.Vij_=V0-V0[:,np.newaxis]
-        self.I2ij_=self.Vij_*self.cfree_/2.0
-        self.Pij_=self.Vij_*self.I2ij_
-        self.PijU=np.triu(self.Pij_)
-        self.totalEdgePower=np.sum(self.PijU)
-        self.maxEdgePower=np.max(self.PijU)
-        self.edgePowerShape=self.PijU.shape
+        # Power on each habitat-habitat link, swept in row blocks (or over
+        # the stored links of a sparse kernel) so the N x N power matrix is
+        # never formed. Only the upper triangle counts, as before.
+        logging.debug("_calcHabLinks()")
+        V0=self.nodeVoltage()
+        n=V0.size
+        ep=EdgePower(1000,100000.0)
+        if sparse.issparse(self.cfree_):
+            c=sparse.triu(self.cfree_,k=1).tocoo()
+            Vij=V0[c.col]-V0[c.row]
+            ep.add(c.row,c.col,Vij*(Vij*c.data/2.0))
+        else:
+            cols=np.arange(n)
+            for r0,r1,blk in self._cfreeRows():
+                Vij=V0-V0[r0:r1,np.newaxis]
+                P=Vij*(Vij*blk/2.0)
+                P[cols<=np.arange(r0,r1)[:,np.newaxis]]=0
+                ep.addBlock(r0,P)
+        ep.finish()
+        self.edgePower_=ep
+        self.totalEdgePower=ep.total
+        self.maxEdgePower=ep.max
+        self.edgePowerShape=(n,n)
 
-        pp=self.PijU
         x=self.x()
         y=self.y()
-        ap=self.ap()
-        w=np.where(pp>self.maxEdgePower/100000.0)
-        pps=np.sort(pp[w].flatten())
-        wx1=x[w[0]]
-        wx2=x[w[1]]
-        wy1=y[w[0]]
-        wy2=y[w[1]]
-        wp=pp[w[0],w[1]]
-                
-        tn=topNinds_(pp,1000)
-        xl=tn[0]
-        yl=tn[1]
-        self.sighx1=x[xl]
-        self.sighy1=y[xl]
-        self.sighx2=x[yl]
-        self.sighy2=y[yl]
-        self.sighpow=pp[tn]
-        self.hpps=pps
+        self.sighx1=x[ep.topI]
+        self.sighy1=y[ep.topI]
+        self.sighx2=x[ep.topJ]
+        self.sighy2=y[ep.topJ]
+        self.sighpow=ep.topP
+        self.hpps=np.sort(ep.sigP)
 
     def _calc_stLinks(self):
         V0=self.V0()
@@ -498,10 +1068,279 @@ class CondatisCore(object):
         self.sigpow=pp[tn]
         self.pps=pps
         
+    def _calcDomain(self):
+        self._calcCin()
+        self._calcCout()
+        x,y,ap=self.x(),self.y(),self.ap()
+        cell=self._cell()
+        tol=self.sparseTol_ if self.sparse_ else None
+        ds=domaindecomp.DomainSolver(self._scind(x,cell),self._scind(y,cell),ap,self._K(),self._alpha(),
+                                     self.cin_+self.cout_,ntiles=self.domainTiles_,
+                                     overlap=self.domainOverlap_/self._alpha(),tol=tol)
+        try:
+            V0,self.solveInfo_=ds.solve(self.cin_,tol=self.solverTol_,x0=self._initialGuess(),maxiter=self.maxiter_)
+            flo=ds.freeFlow(V0)/2.0
+            self.tls_=np.sum(ds.rowSum) + np.sum(self.cin_) + np.sum(self.cout_)
+        finally:
+            ds.close()
+        self.cfree_=None
+        self.M0_=None
+        self._flowFromV(V0,flo)
+
     def calc(self):
-        self._calcInput()
+        if self._isDomain():
+            # Workers are started and stopped per call; nothing is cached
+            self._calcDomain()
+            return
+        # The system (and its factor) only needs rebuilding if the inputs changed
+        if not self.inputValid_:
+            self._calcInput()
+            self.inputValid_=True
         self._calcFlow()
 
+    # Parameter sweeps.
+    #
+    # K is proportional to R, and cin, cout and cfree are all proportional
+    # to K, so V0 does not depend on R while speed, flow and total link
+    # strength scale with it exactly. Dispersal only changes alpha, so the
+    # distances can be shared. A sweep therefore computes distances once,
+    # solves once per distinct dispersal at R=1 and scales the results.
+
+    def _sweepStSums(self,px,py,alphas):
+        # Column sums of ap*exp(-alpha*d) against the points (px,py) for
+        # every alpha, computing each block of distances only once
+        x,y,ap=self.x(),self.y(),self.ap()
+        cell=self._cell()
+        xs,ys=self._scind(x,cell),self._scind(y,cell)
+        pxs,pys=self._scind(px,cell),self._scind(py,cell)
+        n,m=xs.size,pxs.size
+        out=np.zeros((len(alphas),n))
+        b=min(self._blockRows(n),max(m,1))
+        dist=np.empty((b,n))
+        tmp=np.empty((b,n))
+        for r0 in range(0,m,b):
+            r1=min(r0+b,m)
+            k=r1-r0
+            self._distBlock(xs,ys,pxs[r0:r1],pys[r0:r1],dist[:k],tmp[:k])
+            for a,alpha in enumerate(alphas):
+                np.multiply(-alpha,dist[:k],out=tmp[:k])
+                np.exp(tmp[:k],out=tmp[:k])
+                out[a]+=np.sum(tmp[:k],axis=0)
+        return out*ap
+
+    def sweep(self,params,flows=False):
+        """
+        Solve the landscape for a list of (R,dispersal) pairs.
+
+        Distances are computed once for the whole sweep, the system is
+        solved once per distinct dispersal and the R variants are derived
+        by scaling. Honours the sparse kernel and solver settings; mixed
+        precision and the hierarchical kernel are not used. The object's own parameters and results
+        are left untouched.
+
+        Args:
+        params: (list of (number,number)), (R,dispersal) pairs.
+        flows: (bool), Also return the node flow for each pair.
+
+        Returns:
+        A pandas DataFrame with one row per pair, in order, and columns
+        R, dispersal, speed, time and totalLinkStrength, plus flow (a 1D
+        array per row) if flows is True.
+        """
+        params=[(float(R),float(d)) for R,d in params]
+        disps=sorted(set(d for R,d in params))
+        alphas=[2.0/d for d in disps]
+        cell=self._cell()
+        x,y,ap=self.x(),self.y(),self.ap()
+        n=x.size
+        xs,ys=self._scind(x,cell),self._scind(y,cell)
+        cin1=self._sweepStSums(self.sx(),self.sy(),alphas)
+        cout1=self._sweepStSums(self.tx(),self.ty(),alphas)
+        dd=np.arange(n)
+        if self.sparse_:
+            # Neighbours within the truncation radius of the longest dispersal
+            pts=np.column_stack((xs,ys))
+            pairs=cKDTree(pts).query_pairs(-np.log(self.sparseTol_)/min(alphas),output_type='ndarray')
+            pi,pj=pairs[:,0],pairs[:,1]
+            pdist=np.sqrt(np.sum((pts[pi]-pts[pj])**2,axis=1))
+            apij=ap[pi]*ap[pj]
+        else:
+            dm=np.empty((n,n))
+            b=min(self._blockRows(n,1),max(n,1))
+            tmp=np.empty((b,n))
+            for r0 in range(0,n,b):
+                r1=min(r0+b,n)
+                self._distBlock(xs,ys,xs[r0:r1],ys[r0:r1],dm[r0:r1],tmp[:r1-r0])
+
+        unit={}
+        for a,alpha in enumerate(alphas):
+            K1=alpha**2/(2.0*np.pi)*cell**4
+            cin=K1*cin1[a]
+            cout=K1*cout1[a]
+            if self.sparse_:
+                e=np.exp(-alpha*pdist)
+                w=e>self.sparseTol_
+                c=K1*apij[w]*e[w]
+                rows=np.concatenate((pi[w],pj[w]))
+                cols=np.concatenate((pj[w],pi[w]))
+                cf=sparse.coo_matrix((np.concatenate((c,c)),(rows,cols)),shape=(n,n)).tocsr()
+                fs=np.asarray(cf.sum(axis=0)).ravel()
+                M0=(sparse.diags(cin+cout+fs,0,format='csr')-cf).tocsr()
+            else:
+                cf=K1*ap*ap[:,np.newaxis]*np.exp(-alpha*dm)
+                cf[dd,dd]=0
+                fs=cf.sum(axis=0)
+                if flows:
+                    M0=np.negative(cf)
+                else:
+                    M0=np.negative(cf,out=cf)
+                M0[dd,dd]=cin+cout+fs
+            V0,info=solvers.solve(M0,cin,method=self.solver_,tol=self.solverTol_,
+                                  precond=self.precond_,maxiter=self.maxiter_)
+            flow=None
+            if flows:
+                flow=self._freeFlow(V0,cf)+V0*cout+(1-V0)*cin
+            unit[disps[a]]=(np.sum(V0*cout),np.sum(fs)+np.sum(cin)+np.sum(cout),flow)
+            logging.debug("sweep(): dispersal %f solved, residual %e" % (disps[a],info.residual))
+
+        columns=['R','dispersal','speed','time','totalLinkStrength']
+        if flows:
+            columns.append('flow')
+        rows=[]
+        for R,d in params:
+            speed,tls,flow=unit[d]
+            row={'R':R,'dispersal':d,'speed':R*speed,'totalLinkStrength':R*tls}
+            row['time']=0.0 if row['speed']==0 else 1.0/row['speed']
+            if flows:
+                row['flow']=R*flow
+            rows.append(row)
+        return pd.DataFrame(rows,columns=columns)
+
+    # Multiresolution.
+    #
+    # Blocks of f x f cells are merged into one coarse cell at their
+    # quality weighted centroid. Links go as the product of the habitat
+    # areas ap*cell^2, so a coarse cell (f^2 times the area) gets the
+    # mean ap of its block and the coarse links approximate the sums of
+    # the fine links between blocks. Source and target cells stay where
+    # they are, so cin and cout, which count them at the coarse cell
+    # area, are scaled back by 1/f^2.
+
+    def _coarseCore(self,f):
+        # A CondatisCore for the coarsened habitat, solved, and the
+        # coarse cell of every fine cell
+        x,y,ap=self.x(),self.y(),self.ap()
+        _,lab=np.unique(np.floor_divide(x,f)+1j*np.floor_divide(y,f),return_inverse=True)
+        nc=lab.max()+1 if lab.size else 0
+        w=np.bincount(lab,ap,minlength=nc)
+        wx=np.where(w[lab]>0,ap,1.0)
+        ws=np.bincount(lab,wx,minlength=nc)
+        xc=(np.bincount(lab,wx*x,minlength=nc)/ws+.5)/f-.5
+        yc=(np.bincount(lab,wx*y,minlength=nc)/ws+.5)/f-.5
+        c=CondatisCore(ls.Landscape.fromVecs(xc,yc,w/float(f)**2))
+        c.map_scale_=self.map_scale()*f
+        c.setParams(self.R(),self.dispersal())
+        c.setSparse(self.sparse_,self.sparseTol_)
+        c.setSolver(self.solver_,self.solverTol_,self.precond_,self.maxiter_)
+        c.setMemoryBudget(self.blockBytes_)
+        c._addSource(ls.Landscape.fromVecs((self.sx()+.5)/f-.5,(self.sy()+.5)/f-.5))
+        c._addTarget(ls.Landscape.fromVecs((self.tx()+.5)/f-.5,(self.ty()+.5)/f-.5))
+        c._calcInput()
+        c.cin_/=float(f)**2
+        c.cout_/=float(f)**2
+        c._calcM0()
+        c._calcTLS()
+        c.inputValid_=True
+        c._calcFlow()
+        return c,lab
+
+    def _twoLevel(self,coarse,lab,d):
+        # Additive two level preconditioner: Jacobi plus a coarse
+        # correction through the factorised coarse M0
+        fac=coarse._factor()
+        nc=coarse.cin_.size
+        inv=1.0/d
+        def apply(r):
+            r=np.ravel(r)
+            return inv*r+fac.solve(np.bincount(lab,r,minlength=nc))[lab]
+        n=d.size
+        return splinalg.LinearOperator((n,n),matvec=apply,dtype=float)
+
+    def calcMultires(self,factor=4,accept=None):
+        """
+        Coarse-to-fine solve.
+
+        The habitat is coarsened by factor (and by 2*factor, for an error
+        estimate) and the coarse problems are solved. If accept is given
+        and the estimated relative error of the coarse speed is within
+        it, the coarse answer is used outright: speed and link strength
+        come from the coarse level, and each cell gets its block's
+        voltage and a share of its block's flow in proportion to ap. The
+        full resolution system is then never built. Otherwise the full
+        problem is solved by conjugate gradient, started from the coarse
+        voltages and preconditioned by the coarse level.
+
+        The coarse levels use the dense or sparse kernel, in float64, even
+        when the hierarchical kernel or mixed precision is on.
+
+        Args:
+        factor: (int), Cells per side in each coarse block (at least 2).
+        accept: (number, Optional), Relative error at which the coarse
+                answer is accepted.
+
+        Returns:
+        A MultiresInfo, also kept for multiresInfo().
+        """
+        factor=int(factor)
+        if factor<2:
+            raise ValueError("calcMultires(): factor must be at least 2")
+        info=MultiresInfo(factor)
+        coarse,lab=self._coarseCore(factor)
+        coarser,_=self._coarseCore(2*factor)
+        info.coarseN=coarse.cin_.size
+        info.coarseSpeed=coarse.speed()
+        info.coarserSpeed=coarser.speed()
+        if info.coarseSpeed!=0:
+            info.estimate=abs(info.coarseSpeed-info.coarserSpeed)/abs(info.coarseSpeed)
+        logging.debug("calcMultires(): %d coarse cells, speed %e, estimated error %e"
+                      % (info.coarseN,info.coarseSpeed,info.estimate))
+        self.multiresInfo_=info
+
+        if accept is not None and info.estimate<=accept:
+            ap=self.ap()
+            w=np.bincount(lab,ap)
+            share=np.where(w[lab]>0,ap/np.where(w[lab]>0,w[lab],1.0),0.0)
+            self.V0_=coarse.V0_[lab]
+            self.Iin_=coarse.Iin_[lab]*share
+            self.Iout_=coarse.Iout_[lab]*share
+            self.flo_=coarse.flo_[lab]*share
+            self.I_=coarse.I_[lab]*share
+            self.cond_=coarse.cond_
+            self.tls_=coarse.tls_
+            self.solveInfo_=coarse.solveInfo_
+            info.accepted=True
+            return info
+
+        if not self.inputValid_:
+            self._calcInput()
+            self.inputValid_=True
+        if self._isHier():
+            d=self.M0diag_
+        elif sparse.issparse(self.M0_):
+            d=self.M0_.diagonal()
+        else:
+            d=np.diag(self.M0_).copy()
+        M0=self.M0_
+        if self._isMixed():
+            M0=splinalg.LinearOperator(M0.shape,matvec=self._M0dot,dtype=float)
+        V0,self.solveInfo_=solvers.solve(M0,self.cin_,method='cg',tol=self.solverTol_,x0=coarse.V0_[lab],
+                                         precond=self._twoLevel(coarse,lab,d),maxiter=self.maxiter_)
+        self._flowFromV(V0)
+        info.solve=self.solveInfo_
+        if self.speed()!=0:
+            info.error=abs(self.speed()-info.coarseSpeed)/abs(self.speed())
+        return info
+
     def calcPower(self):
         print "AAAAAAAAAAAAAAAAAAAAAAAAAAAAARRRRGGGGGGGGGGHHHHH"
         self._calcPower()
@@ -547,6 +1386,20 @@ class CondatisCore(object):
     def nodeVoltageL(self):
         return ls.Landscape.fromVecs(self.x(),self.y(),self.nodeVoltage(),attribs=self.attribs)
 
+    def writeNodeTable(self,fname,fmt='csv'):
+        """
+        Write x, y, voltage and flow of every habitat cell, with the speed,
+        as a table (see tablewriter).
+
+        Args:
+        fname: (string), Name of the file to write.
+        fmt: (string), 'csv', 'hdf' or 'parquet'.
+        """
+        n=self.x().size
+        tablewriter.writeTable(fname,['x','y','voltage','flow','speed'],
+                               [self.x(),self.y(),self.nodeVoltage(),self.nodeFlow(),np.full(n,self.speed())],
+                               ['%f','%f','%e','%e','%e'],fmt=fmt)
+
     def mapinfo(self):
         print "Number of cells:",self.habitatL().len()
         print "EW Raster Size:",self.allHabitat().ewSize()
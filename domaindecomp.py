@@ -0,0 +1,256 @@
+import numpy as np
+import multiprocessing
+import traceback
+from scipy import sparse
+from scipy.sparse import linalg as splinalg
+from scipy.spatial import cKDTree
+import solvers
+import logging
+
+"""
+Overlapping domain decomposition for the Condatis M0 system.
+
+The landscape's extent is cut into a grid of tiles, one worker process
+per tile. Each worker owns the cells in its tile and holds their rows of
+the free-space kernel, so products with M0, the cfree row sums and the
+node flows are computed in parallel and the N x N kernel is never held
+in one place. Each worker also factorises M0 restricted to its tile
+grown by an overlap (a few kernel lengths), and the sum of those local
+solves is used as an additive Schwarz preconditioner for conjugate
+gradient on the master. The iteration converges to the monolithic
+solution; the overlap only affects how many iterations it takes.
+"""
+
+
+def tileGrid(xs,ys,ntiles,minSide):
+    """
+    Number of tiles along x and y.
+
+    Aims for about ntiles tiles, shaped like the extent, but no narrower
+    than minSide.
+
+    Returns:
+    (nx,ny)
+    """
+    w=max(np.ptp(xs),1e-12) if xs.size else 1.0
+    h=max(np.ptp(ys),1e-12) if ys.size else 1.0
+    nx=max(1,int(round(np.sqrt(ntiles*w/h))))
+    nx=min(nx,max(1,int(w//minSide)))
+    ny=max(1,int(np.ceil(ntiles/float(nx))))
+    ny=min(ny,max(1,int(h//minSide)))
+    return nx,ny
+
+
+def tiles(xs,ys,ntiles,overlap):
+    """
+    Split the cells into tiles.
+
+    Args:
+    xs, ys: (1D arrays), Cell positions.
+    ntiles: (int), Number of tiles wanted.
+    overlap: (number), How far each tile's subdomain reaches past it.
+
+    Returns:
+    A list of (own,ext) index arrays, one per non-empty tile: the cells
+    in the tile and the cells within overlap of it.
+    """
+    nx,ny=tileGrid(xs,ys,ntiles,overlap)
+    x0,y0=xs.min(),ys.min()
+    w=max(np.ptp(xs),1e-12)/nx
+    h=max(np.ptp(ys),1e-12)/ny
+    ix=np.minimum(((xs-x0)/w).astype(np.int_),nx-1)
+    iy=np.minimum(((ys-y0)/h).astype(np.int_),ny-1)
+    out=[]
+    for t in range(nx*ny):
+        own=np.where(ix+nx*iy==t)[0]
+        if not own.size:
+            continue
+        tx,ty=t%nx,t//nx
+        ext=np.where((xs>=x0+tx*w-overlap) & (xs<=x0+(tx+1)*w+overlap) &
+                     (ys>=y0+ty*h-overlap) & (ys<=y0+(ty+1)*h+overlap))[0]
+        out.append((own,ext))
+    return out
+
+
+def kernelBlock(xs,ys,ap,K,alpha,rows,cols,tol=None):
+    """
+    Free-space conductances between the cells rows and cols, with the
+    links of a cell to itself left out.
+
+    Args:
+    tol: (number, Optional), If given, drop links with exp(-alpha*d)
+         below tol and return a sparse matrix.
+    """
+    if tol is None:
+        d=np.sqrt((xs[cols]-xs[rows][:,np.newaxis])**2+(ys[cols]-ys[rows][:,np.newaxis])**2)
+        C=K*ap[rows][:,np.newaxis]*ap[cols]*np.exp(-alpha*d)
+        C[d==0]=0
+        return C
+    pr=np.column_stack((xs[rows],ys[rows]))
+    pc=np.column_stack((xs[cols],ys[cols]))
+    D=cKDTree(pr).sparse_distance_matrix(cKDTree(pc),-np.log(tol)/alpha,output_type='coo_matrix')
+    keep=D.data>0
+    i,j,d=D.row[keep],D.col[keep],D.data[keep]
+    c=K*ap[rows][i]*ap[cols][j]*np.exp(-alpha*d)
+    return sparse.csr_matrix((c,(i,j)),shape=(len(rows),len(cols)))
+
+
+def _worker(conn,xs,ys,ap,K,alpha,own,ext,tol):
+    # One tile. Holds its rows of cfree and the factor of its subdomain.
+    C=None
+    fac=None
+    while True:
+        try:
+            cmd,arg=conn.recv()
+        except EOFError:
+            # The master has gone
+            return
+        if cmd=='stop':
+            conn.close()
+            return
+        try:
+            if cmd=='rowsum':
+                C=kernelBlock(xs,ys,ap,K,alpha,own,np.arange(xs.size),tol)
+                res=np.asarray(C.sum(axis=1)).ravel()
+            elif cmd=='factor':
+                A=-kernelBlock(xs,ys,ap,K,alpha,ext,ext,tol)
+                if sparse.issparse(A):
+                    A=(A+sparse.diags(arg,0)).tocsc()
+                else:
+                    A[np.arange(ext.size),np.arange(ext.size)]=arg
+                fac=solvers.factor(A)
+                res=None
+            elif cmd=='dot':
+                res=C.dot(arg)
+            elif cmd=='prec':
+                res=fac.solve(arg)
+            elif cmd=='flow':
+                if sparse.issparse(C):
+                    c=C.tocoo()
+                    res=np.bincount(c.row,weights=np.abs(c.data*(arg[c.col]-arg[own][c.row])),minlength=own.size)
+                else:
+                    res=np.sum(np.abs(C*(arg-arg[own][:,np.newaxis])),axis=1)
+            else:
+                raise ValueError("unknown command '%s'" % cmd)
+            conn.send(('ok',res))
+        except Exception, e:
+            conn.send(('error',str(e)+"\n"+traceback.format_exc()))
+
+
+class DomainSolver(object):
+    """
+    Worker processes for one M0 system, split into overlapping tiles.
+
+    Args:
+    xs, ys: (1D arrays), Scaled cell positions.
+    ap: (1D array), Habitat quality.
+    K: (number), Kernel constant.
+    alpha: (number), Kernel decay rate.
+    diag0: (1D array), cin+cout, the rest of the M0 diagonal.
+    ntiles: (int, Optional), Number of tiles (and processes). Defaults to
+            the number of CPUs.
+    overlap: (number, Optional), Subdomain overlap. Defaults to 1/alpha.
+    tol: (number, Optional), Truncate the kernel as in the sparse mode.
+
+    Call close() when done.
+    """
+    def __init__(self,xs,ys,ap,K,alpha,diag0,ntiles=None,overlap=None,tol=None):
+        if ntiles is None:
+            ntiles=multiprocessing.cpu_count()
+        if overlap is None:
+            overlap=1.0/alpha
+        self.n=xs.size
+        self.tiles=tiles(xs,ys,ntiles,overlap)
+        self.conns=[]
+        self.procs=[]
+        try:
+            for own,ext in self.tiles:
+                a,b=multiprocessing.Pipe()
+                p=multiprocessing.Process(target=_worker,args=(b,xs,ys,ap,K,alpha,own,ext,tol))
+                p.daemon=True
+                p.start()
+                # Only the worker keeps its end, so it sees EOF if we go away
+                b.close()
+                self.conns.append(a)
+                self.procs.append(p)
+            logging.debug("DomainSolver: %d cells in %d tiles, subdomains of %d to %d cells"
+                          % (self.n,len(self.tiles),min(e.size for o,e in self.tiles),max(e.size for o,e in self.tiles)))
+            self.rowSum=np.empty(self.n)
+            for (own,ext),r in zip(self.tiles,self._all('rowsum')):
+                self.rowSum[own]=r
+            self.diag=diag0+self.rowSum
+            self._all('factor',[self.diag[ext] for own,ext in self.tiles])
+        except:
+            self.close()
+            raise
+
+    def _all(self,cmd,args=None):
+        # Send a command to every worker, then collect the answers, so the
+        # workers run concurrently
+        for k,c in enumerate(self.conns):
+            c.send((cmd,None if args is None else args[k]))
+        out=[]
+        for c in self.conns:
+            status,res=c.recv()
+            if status!='ok':
+                raise RuntimeError("DomainSolver: worker failed: %s" % res)
+            out.append(res)
+        return out
+
+    def dot(self,v):
+        """
+        M0 times v.
+        """
+        v=np.ravel(v)
+        w=self.diag*v
+        for (own,ext),r in zip(self.tiles,self._all('dot',[v]*len(self.tiles))):
+            w[own]-=r
+        return w
+
+    def precondition(self,r):
+        """
+        Additive Schwarz: the sum of the subdomain solves.
+        """
+        r=np.ravel(r)
+        z=np.zeros(self.n)
+        for (own,ext),s in zip(self.tiles,self._all('prec',[r[ext] for own,ext in self.tiles])):
+            z[ext]+=s
+        return z
+
+    def freeFlow(self,V0):
+        """
+        sum_j cfree_ij*|V0_j-V0_i| for every cell.
+        """
+        f=np.empty(self.n)
+        for (own,ext),r in zip(self.tiles,self._all('flow',[V0]*len(self.tiles))):
+            f[own]=r
+        return f
+
+    def solve(self,b,tol=1e-8,x0=None,maxiter=None):
+        """
+        Solve M0 x = b by conjugate gradient.
+
+        Returns:
+        (x,info), The solution and a SolveInfo.
+        """
+        shape=(self.n,self.n)
+        M=splinalg.LinearOperator(shape,matvec=self.dot,dtype=float)
+        P=splinalg.LinearOperator(shape,matvec=self.precondition,dtype=float)
+        x,info=solvers.solve(M,b,method='cg',tol=tol,x0=x0,precond=P,maxiter=maxiter)
+        info.precond='schwarz'
+        return x,info
+
+    def close(self):
+        """
+        Stop the workers.
+        """
+        for c in self.conns:
+            try:
+                c.send(('stop',None))
+            except (IOError,EOFError):
+                pass
+            c.close()
+        for p in self.procs:
+            p.join()
+        self.conns=[]
+        self.procs=[]
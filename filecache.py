@@ -0,0 +1,243 @@
+import numpy as np
+import os
+import shutil
+import tempfile
+import hashlib
+import cPickle as pickle
+import logging
+
+"""
+On-disk cache of data parsed from input files, or of results computed
+from any inputs that can be hashed (see get() and put()).
+
+Entries are keyed by a hash of the file's content (plus a tag naming
+what was extracted), so a renamed or re-uploaded copy of the same raster
+is still a hit. Hashing a large file is itself slow, so the hash of each
+path is remembered along with the file's size and modification time,
+and only recomputed when either changes.
+
+Arrays are stored as .npy files and loaded memory mapped (copy on write),
+so a hit costs almost nothing and the arrays are only paged in as they
+are used. Other data goes in a pickle. Entries are written to a
+temporary directory and renamed into place, so several processes can
+share a cache. When the cache grows past its size limit the least
+recently used entries are removed.
+"""
+
+def fileHash(fname,chunk=1<<20):
+    """
+    sha1 of a file's content, as a hex string.
+    """
+    h=hashlib.sha1()
+    with open(fname,'rb') as f:
+        while True:
+            b=f.read(chunk)
+            if not b:
+                break
+            h.update(b)
+    return h.hexdigest()
+
+
+class FileCache(object):
+    """
+    A directory of cached parse results.
+
+    Args:
+    directory: (string), Where to keep the cache. Made if missing.
+    maxBytes: (int, Optional), Size limit. None for no limit.
+    """
+    def __init__(self,directory,maxBytes=None):
+        self.directory=directory
+        self.maxBytes=maxBytes
+        self.dataDir=os.path.join(directory,'data')
+        self.pathDir=os.path.join(directory,'paths')
+        for d in (self.dataDir,self.pathDir):
+            if not os.path.isdir(d):
+                try:
+                    os.makedirs(d)
+                except OSError:
+                    # Another process may have made it
+                    if not os.path.isdir(d):
+                        raise
+
+    def _pathFile(self,fname):
+        return os.path.join(self.pathDir,hashlib.sha1(os.path.abspath(fname)).hexdigest())
+
+    def contentKey(self,fname):
+        """
+        Content hash of fname, from the path index where the file's size
+        and mtime are unchanged.
+        """
+        st=os.stat(fname)
+        stamp="%d %r" % (st.st_size,st.st_mtime)
+        pf=self._pathFile(fname)
+        try:
+            with open(pf) as f:
+                s,h=f.read().rsplit(' ',1)
+            if s==stamp:
+                return h
+        except (IOError,ValueError):
+            pass
+        h=fileHash(fname)
+        self._atomicWrite(pf,stamp+' '+h)
+        return h
+
+    def _atomicWrite(self,fname,text):
+        fd,tmp=tempfile.mkstemp(dir=os.path.dirname(fname))
+        with os.fdopen(fd,'w') as f:
+            f.write(text)
+        os.rename(tmp,fname)
+
+    def _entry(self,key,tag):
+        return os.path.join(self.dataDir,key+'-'+tag)
+
+    def _load(self,entry):
+        with open(os.path.join(entry,'meta.pkl'),'rb') as f:
+            names,meta=pickle.load(f)
+        arrays={}
+        for k in names:
+            p=os.path.join(entry,k+'.npy')
+            try:
+                arrays[k]=np.asarray(np.load(p,mmap_mode='c'))
+            except ValueError:
+                # Zero length arrays can't be mapped
+                arrays[k]=np.load(p)
+        return arrays,meta
+
+    def _store(self,entry,arrays,meta):
+        tmp=tempfile.mkdtemp(dir=self.dataDir,prefix='.tmp')
+        try:
+            for k,a in arrays.items():
+                np.save(os.path.join(tmp,k+'.npy'),np.ascontiguousarray(a))
+            with open(os.path.join(tmp,'meta.pkl'),'wb') as f:
+                pickle.dump((sorted(arrays),meta),f,pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp,entry)
+        except OSError:
+            # Lost a race with another process storing the same entry
+            shutil.rmtree(tmp,ignore_errors=True)
+            if not os.path.isdir(entry):
+                raise
+
+    def get(self,key,tag):
+        """
+        The (arrays,meta) stored under key and tag by put(), or None. The
+        arrays are copy on write memory maps.
+        """
+        entry=self._entry(key,tag)
+        try:
+            if os.path.isdir(entry):
+                res=self._load(entry)
+                os.utime(entry,None)
+                return res
+        except (IOError,OSError,EOFError,ValueError,pickle.UnpicklingError), e:
+            logging.warning("FileCache: can't read entry %s: %s" % (entry,e))
+        return None
+
+    def put(self,key,tag,arrays,meta):
+        """
+        Store a dict of numpy arrays and a picklable object under key (a
+        hash of whatever they were made from) and tag, then evict.
+        """
+        entry=self._entry(key,tag)
+        try:
+            self._store(entry,arrays,meta)
+            self.evict(keep=entry)
+        except (IOError,OSError), e:
+            logging.warning("FileCache: can't store entry %s: %s" % (entry,e))
+
+    def fetch(self,fname,build,tag):
+        """
+        Cached result of build(fname), building and storing it on a miss.
+
+        Args:
+        fname: (string), The input file.
+        build: (function), Returns (arrays,meta) for a file: a dict of
+               numpy arrays and any picklable object.
+        tag: (string), Names what build extracts. Change it whenever
+             build would give a different answer for the same file.
+
+        Returns:
+        (arrays,meta). On a hit the arrays are copy on write memory maps.
+        """
+        try:
+            key=self.contentKey(fname)
+        except (IOError,OSError), e:
+            logging.warning("FileCache: can't hash %s: %s" % (fname,e))
+            return build(fname)
+        res=self.get(key,tag)
+        if res is not None:
+            logging.debug("FileCache: hit %s" % fname)
+            return res
+        arrays,meta=build(fname)
+        self.put(key,tag,arrays,meta)
+        return arrays,meta
+
+    def entries(self):
+        """
+        (mtime,bytes,path) of every entry, least recently used first.
+        """
+        out=[]
+        for name in os.listdir(self.dataDir):
+            if name.startswith('.tmp'):
+                continue
+            p=os.path.join(self.dataDir,name)
+            try:
+                size=sum(os.path.getsize(os.path.join(p,f)) for f in os.listdir(p))
+                out.append((os.path.getmtime(p),size,p))
+            except OSError:
+                # Evicted by another process meanwhile
+                pass
+        out.sort()
+        return out
+
+    def size(self):
+        """
+        Total bytes held.
+        """
+        return sum(s for t,s,p in self.entries())
+
+    def evict(self,keep=None):
+        """
+        Remove least recently used entries until the cache is within
+        maxBytes. Open memory maps of removed entries stay valid.
+        """
+        if self.maxBytes is None:
+            return
+        ents=self.entries()
+        total=sum(s for t,s,p in ents)
+        for t,s,p in ents:
+            if total<=self.maxBytes:
+                break
+            if p==keep:
+                continue
+            shutil.rmtree(p,ignore_errors=True)
+            total-=s
+            logging.debug("FileCache: evicted %s" % p)
+
+    def clear(self):
+        """
+        Remove every entry.
+        """
+        for t,s,p in self.entries():
+            shutil.rmtree(p,ignore_errors=True)
+
+
+_default=[]
+
+def default():
+    """
+    The process wide cache, in $CONDATIS_CACHE (default ~/.condatis_cache)
+    limited to $CONDATIS_CACHE_MB megabytes (default 2048). Returns None,
+    so callers read files directly, if CONDATIS_CACHE is set empty or
+    the directory can't be made.
+    """
+    if not _default:
+        d=os.environ.get('CONDATIS_CACHE',os.path.join(os.path.expanduser('~'),'.condatis_cache'))
+        c=None
+        if d:
+            try:
+                c=FileCache(d,int(float(os.environ.get('CONDATIS_CACHE_MB',2048))*(1<<20)))
+            except (IOError,OSError), e:
+                logging.warning("FileCache: no cache in %s: %s" % (d,e))
+        _default.append(c)
+    return _default[0]
@@ -8,6 +8,14 @@ class GISAttribs(object):
     @classmethod
     def fromFile(cls,fname):
         gd = gdal.Open(fname, gdal.GA_ReadOnly)
+        return cls.fromDataset(gd,fname)
+
+    @classmethod
+    def fromDataset(cls,gd,fname):
+        """
+        Attributes of a dataset that is already open, so the caller
+        can go on reading it.
+        """
         c=cls()
         c.filename=fname
         c.datatype = gdal.GetDataTypeName(gd.GetRasterBand(1).DataType)
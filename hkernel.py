@@ -0,0 +1,293 @@
+import numpy as np
+from scipy.sparse import linalg as splinalg
+import logging
+
+"""
+Hierarchical approximation of the Condatis free-space kernel.
+
+The kernel c_ij = scale*w_i*w_j*exp(-alpha*|p_i-p_j|) (zero on the
+diagonal) is never stored as an N x N matrix. The cells are sorted into
+a quadtree, and the matrix is split into blocks between pairs of
+clusters. Blocks between clusters that are far apart compared with their
+size are smooth and are held as low rank products U*V, built by adaptive
+cross approximation (ACA) to a relative tolerance. Only the blocks
+between neighbouring leaves are held densely. Storage and matrix-vector
+products then grow roughly as N*log(N) rather than N^2, which is what an
+iterative solve of M0 needs.
+
+Only one triangle of the block structure is kept; the kernel is
+symmetric, so each off-diagonal block also acts as its transpose.
+"""
+
+
+class HKernel(object):
+    """
+    Hierarchical matrix for the weighted exponential kernel.
+
+    Args:
+    x: (1D array), Cell x coordinates.
+    y: (1D array), Cell y coordinates.
+    w: (1D array), Cell weights (habitat quality).
+    alpha: (number), Kernel decay rate, in the units of x and y.
+    scale: (number), Constant factor applied to every entry.
+    tol: (number), Relative accuracy of each low rank block.
+    leafSize: (int), Largest number of cells in a quadtree leaf.
+    eta: (number), Admissibility: two clusters are approximated when
+         the larger diameter is at most eta times their separation.
+    """
+    def __init__(self,x,y,w,alpha,scale=1.0,tol=1e-6,leafSize=128,eta=1.0):
+        self.n=x.size
+        self.alpha=alpha
+        self.scale=scale
+        self.tol=tol
+        self.leafSize=leafSize
+        self.eta=eta
+        self._buildTree(np.asarray(x,float),np.asarray(y,float))
+        self.x=np.asarray(x,float)[self.perm]
+        self.y=np.asarray(y,float)[self.perm]
+        self.w=np.asarray(w,float)[self.perm]
+        self._buildBlocks()
+        self.rowSum_=None
+
+    # Cluster tree
+
+    def _buildTree(self,x,y):
+        # Quadtree over the bounding boxes. Each cluster is a contiguous
+        # range start:end of the permuted cell order.
+        self.perm=np.arange(self.n)
+        self.start=[]
+        self.end=[]
+        self.lo=[]
+        self.hi=[]
+        self.children=[]
+        if self.n:
+            self._cluster(x,y,0,self.n)
+
+    def _cluster(self,x,y,s,e):
+        idx=self.perm[s:e]
+        px,py=x[idx],y[idx]
+        lo=np.array([px.min(),py.min()])
+        hi=np.array([px.max(),py.max()])
+        k=len(self.start)
+        self.start.append(s)
+        self.end.append(e)
+        self.lo.append(lo)
+        self.hi.append(hi)
+        self.children.append([])
+        if e-s>self.leafSize and np.any(hi>lo):
+            c=(lo+hi)/2.0
+            q=(px>c[0]).astype(np.int_)+2*(py>c[1])
+            self.perm[s:e]=idx[np.argsort(q,kind='mergesort')]
+            a=s
+            kids=[]
+            for cnt in np.bincount(q,minlength=4):
+                if cnt:
+                    kids.append(self._cluster(x,y,a,a+cnt))
+                    a+=cnt
+            self.children[k]=kids
+        return k
+
+    def _slice(self,a):
+        return slice(self.start[a],self.end[a])
+
+    def _size(self,a):
+        return self.end[a]-self.start[a]
+
+    def _diam(self,a):
+        return np.sqrt(np.sum((self.hi[a]-self.lo[a])**2))
+
+    def _dist(self,a,b):
+        gap=np.maximum(0.0,np.maximum(self.lo[b]-self.hi[a],self.lo[a]-self.hi[b]))
+        return np.sqrt(np.sum(gap**2))
+
+    def _admissible(self,a,b):
+        d=self._dist(a,b)
+        return d>0 and max(self._diam(a),self._diam(b))<=self.eta*d
+
+    # Blocks
+
+    def _dense(self,a,b):
+        sa,sb=self._slice(a),self._slice(b)
+        d=np.sqrt((self.x[sb]-self.x[sa][:,np.newaxis])**2+(self.y[sb]-self.y[sa][:,np.newaxis])**2)
+        B=self.w[sa][:,np.newaxis]*self.w[sb]*np.exp(-self.alpha*d)
+        if a==b:
+            dd=np.arange(B.shape[0])
+            B[dd,dd]=0
+        return B
+
+    def _row(self,i,sb):
+        d=np.sqrt((self.x[sb]-self.x[i])**2+(self.y[sb]-self.y[i])**2)
+        return self.w[i]*self.w[sb]*np.exp(-self.alpha*d)
+
+    def _aca(self,a,b):
+        # Adaptive cross approximation with partial pivoting. Returns
+        # (U,V) with block ~ U.dot(V), or (None,None) if the rank needed
+        # makes the dense block cheaper.
+        sa,sb=self._slice(a),self._slice(b)
+        m,n=self._size(a),self._size(b)
+        # Give up once the factors would be as big as the dense block
+        kmax=(m*n)//(m+n)
+        U=np.empty((m,kmax+1))
+        V=np.empty((kmax+1,n))
+        used=np.zeros(m,bool)
+        i=0
+        k=0
+        norm2=0.0
+        while k<=kmax:
+            used[i]=True
+            r=self._row(sa.start+i,sb)-U[i,:k].dot(V[:k])
+            j=np.argmax(np.abs(r))
+            if r[j]==0:
+                free=np.where(~used)[0]
+                if not free.size:
+                    break
+                i=free[0]
+                continue
+            r/=r[j]
+            c=self._row(sb.start+j,sa)-U[:,:k].dot(V[:k,j])
+            nc=np.dot(c,c)
+            nr=np.dot(r,r)
+            norm2+=nc*nr+2.0*np.dot(c.dot(U[:,:k]),V[:k].dot(r))
+            U[:,k]=c
+            V[k]=r
+            k+=1
+            if np.sqrt(nc*nr)<=self.tol*np.sqrt(abs(norm2)):
+                break
+            ac=np.abs(c)
+            ac[used]=-1.0
+            i=np.argmax(ac)
+            if used[i]:
+                break
+        if k>kmax:
+            return None,None
+        return U[:,:k].copy(),V[:k].copy()
+
+    def _buildBlocks(self):
+        # near: (a,b,B) dense, far: (a,b,U,V) low rank; a<=b in tree order
+        self.near=[]
+        self.far=[]
+        if not self.n:
+            return
+        stack=[(0,0)]
+        while stack:
+            a,b=stack.pop()
+            if a!=b and self._admissible(a,b):
+                U,V=self._aca(a,b)
+                if U is None:
+                    self.near.append((a,b,self._dense(a,b)))
+                else:
+                    self.far.append((a,b,U,V))
+                continue
+            ka,kb=self.children[a],self.children[b]
+            if a==b:
+                if not ka:
+                    self.near.append((a,b,self._dense(a,b)))
+                else:
+                    for i,ci in enumerate(ka):
+                        for cj in ka[i:]:
+                            stack.append((ci,cj))
+            elif not ka and not kb:
+                self.near.append((a,b,self._dense(a,b)))
+            elif ka and (not kb or self._diam(a)>=self._diam(b)):
+                stack.extend((c,b) for c in ka)
+            else:
+                stack.extend((a,c) for c in kb)
+        logging.debug("HKernel: %d cells, %d dense blocks, %d low rank blocks, %d stored values"
+                      % (self.n,len(self.near),len(self.far),self.storage()))
+
+    def storage(self):
+        """
+        Number of floating point values held by the blocks.
+        """
+        return sum(B.size for a,b,B in self.near)+sum(U.size+V.size for a,b,U,V in self.far)
+
+    def ranks(self):
+        """
+        Ranks of the low rank blocks.
+        """
+        return np.array([U.shape[1] for a,b,U,V in self.far],np.int_)
+
+    # Products
+
+    def dot(self,v):
+        """
+        Kernel times a vector, in the caller's cell order.
+        """
+        vp=np.asarray(v,float)[self.perm]
+        yp=np.zeros(self.n)
+        for a,b,B in self.near:
+            sa,sb=self._slice(a),self._slice(b)
+            yp[sa]+=B.dot(vp[sb])
+            if a!=b:
+                yp[sb]+=B.T.dot(vp[sa])
+        for a,b,U,V in self.far:
+            sa,sb=self._slice(a),self._slice(b)
+            yp[sa]+=U.dot(V.dot(vp[sb]))
+            yp[sb]+=V.T.dot(U.T.dot(vp[sa]))
+        out=np.empty(self.n)
+        out[self.perm]=self.scale*yp
+        return out
+
+    def rowSum(self):
+        """
+        Row (= column) sums of the kernel, computed once.
+        """
+        if self.rowSum_ is None:
+            self.rowSum_=self.dot(np.ones(self.n))
+        return self.rowSum_
+
+    def system(self,d):
+        """
+        LinearOperator for diag(d) - kernel.
+        """
+        return splinalg.LinearOperator((self.n,self.n),matvec=lambda v: d*np.ravel(v)-self.dot(v),dtype=float)
+
+    def absFlow(self,v):
+        """
+        sum_j c_ij*|v_j-v_i| for every cell i, in the caller's cell order.
+
+        Not a linear product, but where every v in one cluster is at or
+        below every v in the other the absolute value is a fixed sign and
+        the low rank form applies. Far blocks without that separation are
+        split down the tree until it holds or the blocks are small enough
+        to evaluate directly. When v is smooth (as voltages are) the
+        split is rarely needed.
+        """
+        vp=np.asarray(v,float)[self.perm]
+        f=np.zeros(self.n)
+        vlo=[vp[s:e].min() for s,e in zip(self.start,self.end)]
+        vhi=[vp[s:e].max() for s,e in zip(self.start,self.end)]
+
+        def dense(a,b,B):
+            sa,sb=self._slice(a),self._slice(b)
+            D=np.abs(B*(vp[sb]-vp[sa][:,np.newaxis]))
+            f[sa]+=D.sum(axis=1)
+            if a!=b:
+                f[sb]+=D.sum(axis=0)
+
+        for a,b,B in self.near:
+            dense(a,b,B)
+        stack=list(self.far)
+        while stack:
+            a,b,U,V=stack.pop()
+            sa,sb=self._slice(a),self._slice(b)
+            if vlo[b]>=vhi[a] or vlo[a]>=vhi[b]:
+                s=1.0 if vlo[b]>=vhi[a] else -1.0
+                if U is None:
+                    U,V=self._aca(a,b)
+                if U is None:
+                    dense(a,b,self._dense(a,b))
+                    continue
+                f[sa]+=s*(U.dot(V.dot(vp[sb]))-vp[sa]*U.dot(V.sum(axis=1)))
+                f[sb]+=s*(vp[sb]*V.T.dot(U.sum(axis=0))-V.T.dot(U.T.dot(vp[sa])))
+                continue
+            ka,kb=self.children[a],self.children[b]
+            if (not ka and not kb) or self._size(a)*self._size(b)<=self.leafSize**2:
+                dense(a,b,self._dense(a,b))
+            elif ka and (not kb or self._diam(a)>=self._diam(b)):
+                stack.extend((c,b,None,None) for c in ka)
+            else:
+                stack.extend((a,c,None,None) for c in kb)
+        out=np.empty(self.n)
+        out[self.perm]=self.scale*f
+        return out
@@ -1,14 +1,17 @@
 import numpy as np
 from osgeo import gdal
 import logging
-import copy
 from osgeo import osr
 import gisattribs as ga
+import tablewriter
 import traceback
 """
 Landscape class.
 """
 
+# Names what fromGIS() extracts, for FileCache. Change it if that changes.
+GIS_CACHE_TAG='gis2'
+
 def biggestImage(l1,l2):
     t1=l1.imageSize()
     t2=l2.imageSize()
@@ -17,17 +20,341 @@ def biggestImage(l1,l2):
     xr=max(tx1,tx2)
     yr=max(ty1,ty2)
     return (xr,yr)
+
+def _emptyWindow(band,xoff,yoff,xs,ys):
+    # True if GDAL knows the window holds no data (e.g. sparse or
+    # unwritten tiles), so it needn't be read. Needs GDAL >= 2.2.
+    try:
+        flags,pct=band.GetDataCoverageStatus(xoff,yoff,xs,ys)
+        return flags==gdal.GDAL_DATA_COVERAGE_STATUS_EMPTY
+    except (AttributeError,RuntimeError):
+        return False
+
+def readHabitat(band,ndv=None,maxPixels=1<<22):
+    """
+    Habitat cells of a raster band, read one window at a time.
+
+    Windows are whole numbers of the band's native blocks, up to about
+    maxPixels each, so every block is decoded once. Windows that GDAL
+    reports as empty are skipped without reading.
+
+    Args:
+    band: (GDAL band), The band to read.
+    ndv: (number, Optional), No data value; these cells are not habitat.
+    maxPixels: (int), Rough size limit of a window.
+
+    Returns:
+    (rows,cols,vals), Pixel row, column and value of every cell with a
+    value above zero, in row major order (as np.where on the full array).
+    """
+    xsize,ysize=band.XSize,band.YSize
+    bx,by=band.GetBlockSize()
+    bx=max(1,min(bx,xsize))
+    by=max(1,min(by,ysize))
+    wx=min(xsize,max(1,int(np.sqrt(maxPixels))//bx)*bx)
+    wy=min(ysize,max(1,maxPixels//(wx*by))*by)
+    rows=[]
+    cols=[]
+    vals=[]
+    for yoff in range(0,ysize,wy):
+        ys=min(wy,ysize-yoff)
+        for xoff in range(0,xsize,wx):
+            xs=min(wx,xsize-xoff)
+            if _emptyWindow(band,xoff,yoff,xs,ys):
+                continue
+            h=band.ReadAsArray(xoff,yoff,xs,ys)
+            hab=h>0
+            if ndv is not None:
+                hab&=(h!=ndv)
+            r,c=np.nonzero(hab)
+            if not r.size:
+                continue
+            vals.append(h[r,c]*1.0)
+            rows.append(r+yoff)
+            cols.append(c+xoff)
+    if not rows:
+        return np.zeros(0,np.int_),np.zeros(0,np.int_),np.zeros(0)
+    rows=np.concatenate(rows)
+    cols=np.concatenate(cols)
+    vals=np.concatenate(vals)
+    if wx<xsize:
+        # Windows side by side come out window by window
+        o=np.lexsort((cols,rows))
+        rows,cols,vals=rows[o],cols[o],vals[o]
+    return rows,cols,vals
+
+# numpy types that GeoTIFF bands can hold
+_GDAL_TYPES={np.dtype(np.uint8):gdal.GDT_Byte,
+             np.dtype(np.int16):gdal.GDT_Int16,
+             np.dtype(np.uint16):gdal.GDT_UInt16,
+             np.dtype(np.int32):gdal.GDT_Int32,
+             np.dtype(np.uint32):gdal.GDT_UInt32,
+             np.dtype(np.float32):gdal.GDT_Float32,
+             np.dtype(np.float64):gdal.GDT_Float64}
+
+def writeGeoTIFF(fname,layers,dtype=np.float64,names=None,compress='DEFLATE',blockSize=256):
+    """
+    Write landscapes as the bands of a tiled GeoTIFF.
+
+    Only the tiles holding cells are built and written, one at a time
+    from the cells' pixel indices, so time and memory go with the number
+    of cells rather than the size of the raster. Cells off the grid are
+    left out. Everywhere else is 0. When the no data value is not 0 the
+    empty tiles have to be written as well (as 0, each once), so then
+    time and file size go with the size of the raster.
+
+    Args:
+    fname: (string), Name of the file to write.
+    layers: (list of Landscapes), One per band, on the grid of the first
+            one's attribs.
+    dtype: (numpy dtype), Type of the values in the file.
+    names: (list of strings, Optional), Band descriptions.
+    compress: (string), GeoTIFF compression (e.g. 'DEFLATE', 'LZW'), or
+              None.
+    blockSize: (int), Side of the square tiles; a multiple of 16.
+    """
+    attribs=layers[0].attribs
+    dtype=np.dtype(dtype)
+    if dtype not in _GDAL_TYPES:
+        raise ValueError("writeGeoTIFF(): can't write %s" % dtype)
+    NDV=attribs.ndv
+    if not NDV:
+        NDV=0
+    xsize = attribs.xsize
+    ysize = attribs.ysize
+    opts=['TILED=YES','BLOCKXSIZE=%d' % blockSize,'BLOCKYSIZE=%d' % blockSize,'BIGTIFF=IF_SAFER']
+    if compress:
+        opts.append('COMPRESS=%s' % compress)
+    if NDV==0:
+        # Tiles never written read back as the no data value, 0
+        opts.append('SPARSE_OK=TRUE')
+    if len(layers)>1:
+        # Each band is written in turn, so keep them in separate tiles
+        opts.append('INTERLEAVE=BAND')
+    Projection = osr.SpatialReference()
+    Projection.ImportFromWkt(attribs.projectionref)
+    driver = gdal.GetDriverByName("GTiff")
+    DataSet = driver.Create( fname, xsize, ysize, len(layers), _GDAL_TYPES[dtype], opts )
+    DataSet.SetGeoTransform(attribs.geotransform)
+    DataSet.SetProjection( Projection.ExportToWkt() )
+    for b,l in enumerate(layers):
+        band=DataSet.GetRasterBand(b+1)
+        band.SetNoDataValue(NDV)
+        if names is not None:
+            band.SetDescription(names[b])
+        if l._sameGrid(layers[0]):
+            px,py=l.pixels()
+        else:
+            px,py=layers[0]._toPixels(l.x,l.y)
+        v=np.asarray(l.v,dtype)
+        on=(px>=0) & (px<xsize) & (py>=0) & (py<ysize)
+        if not np.all(on):
+            logging.warning("writeGeoTIFF(): %d cells off the grid not written" % np.sum(~on))
+            px,py,v=px[on],py[on],v[on]
+        ntx=(xsize+blockSize-1)//blockSize
+        tx=px//blockSize
+        ty=py//blockSize
+        # Stable, so a repeated cell keeps its last value as image() does
+        o=np.argsort(ty*ntx+tx,kind='mergesort')
+        px,py,v,tx,ty=px[o],py[o],v[o],tx[o],ty[o]
+        starts=np.flatnonzero(np.r_[True,(tx[1:]!=tx[:-1]) | (ty[1:]!=ty[:-1])]) if px.size else np.empty(0,np.int_)
+        if NDV!=0:
+            # Unwritten tiles would read back as no data, not 0
+            zero=np.zeros((blockSize,blockSize),dtype)
+            nty=(ysize+blockSize-1)//blockSize
+            for k in np.setdiff1d(np.arange(ntx*nty),ty[starts]*ntx+tx[starts]):
+                xoff=int(k%ntx)*blockSize
+                yoff=int(k//ntx)*blockSize
+                band.WriteArray(zero[:min(blockSize,ysize-yoff),:min(blockSize,xsize-xoff)],xoff,yoff)
+        for s,e in zip(starts,np.r_[starts[1:],px.size]):
+            xoff=int(tx[s])*blockSize
+            yoff=int(ty[s])*blockSize
+            tile=np.zeros((min(blockSize,ysize-yoff),min(blockSize,xsize-xoff)),dtype)
+            tile[py[s:e]-yoff,px[s:e]-xoff]=v[s:e]
+            band.WriteArray(tile,xoff,yoff)
+    DataSet.FlushCache()
+    DataSet=None
+    logging.info("GIS file %s written" % fname)
+
+def cellKeys(x1,y1,x2,y2):
+    """
+    Integer keys for two sets of cell coordinates, equal exactly where
+    the coordinates are. Integer (pixel) coordinates map to linear
+    indices over their joint extent; anything else is numbered by
+    sorting.
+
+    Returns:
+    (k1,k2), Key arrays for the first and second sets.
+    """
+    x=np.concatenate((np.asarray(x1).ravel(),np.asarray(x2).ravel()))
+    y=np.concatenate((np.asarray(y1).ravel(),np.asarray(y2).ravel()))
+    n1=np.size(x1)
+    if x.size==0:
+        return np.empty(0,np.int64),np.empty(0,np.int64)
+    if np.all(np.mod(x,1)==0) and np.all(np.mod(y,1)==0):
+        xi=x.astype(np.int64)-np.int64(x.min())
+        yi=y.astype(np.int64)-np.int64(y.min())
+        keys=yi*(xi.max()+1)+xi
+    else:
+        _,keys=np.unique(x+1j*y,return_inverse=True)
+    return keys[:n1],keys[n1:]
     
 
 class Landscape(object):
+    # Landscapes are made and sliced in the inner loops, so they are kept
+    # small: fixed slots, and attribs (which are never modified) shared
+    # between copies rather than duplicated.
+    #
+    # Cells are held either as x and y (kilometres, or whatever the maker
+    # used), or, for landscapes read from GIS files, as int32 pixel
+    # indices px, py with the geotransform in attribs. Then x and y are
+    # worked out from the pixels when first asked for and kept, and set
+    # operations, duplicate checks and exports stay on the integers.
+    # Methods work on whichever pair is held (see _xy()).
+    __slots__=('_x','_y','px','py','v','gt','fname','attribs','name','firstFlow','lastFlow','_buf')
+
     def __init__(self):
-        self.x,self.y,self.v=[np.array([],np.int32) for i in range(3)]
+        self._x,self._y,self.v=[np.array([],np.int32) for i in range(3)]
+        self.px=None
+        self.py=None
         self.gt=None
         self.fname=None
         self.attribs=None
         self.name="Landscape"
+        self.firstFlow=None
+        self.lastFlow=None
+        # Spare capacity behind x, y and v for grow()
+        self._buf=None
 #        self.viewSize=None
 
+    def __getstate__(self):
+        return dict((k,getattr(self,k)) for k in self.__slots__ if k!='_buf')
+
+    def __setstate__(self,state):
+        self._buf=None
+        self.px=None
+        self.py=None
+        for k,v in state.items():
+            setattr(self,k,v)
+
+    @property
+    def x(self):
+        if self._x is None:
+            self._x,self._y=self._toXY(self.px,self.py)
+        return self._x
+
+    @x.setter
+    def x(self,a):
+        self._leavePixels()
+        self._x=a
+
+    @property
+    def y(self):
+        if self._y is None:
+            self._x,self._y=self._toXY(self.px,self.py)
+        return self._y
+
+    @y.setter
+    def y(self,a):
+        self._leavePixels()
+        self._y=a
+
+    def _leavePixels(self):
+        # Switch to holding x and y, before one of them is replaced
+        if self.px is not None:
+            if self._x is None:
+                self._x,self._y=self._toXY(self.px,self.py)
+            self.px=None
+            self.py=None
+            self._buf=None
+
+    def _georef(self):
+        return self.attribs is not None and getattr(self.attribs,'geotransform',None) is not None
+
+    def _toXY(self,px,py):
+        # Pixel indices to x, y (as fromGIS has always placed them)
+        gt=self.attribs.geotransform
+        x=(px*gt[1]+gt[0])/1000+0.5
+        y=(py*gt[5]+gt[3])/1000-0.5
+        return x,y
+
+    def _toPixels(self,x,y):
+        # x, y to the nearest pixel indices
+        gt=self.attribs.geotransform
+        px=np.rint(((np.asarray(x)-0.5)*1000-gt[0])/gt[1]).astype(np.int32)
+        py=np.rint(((np.asarray(y)+0.5)*1000-gt[3])/gt[5]).astype(np.int32)
+        return px,py
+
+    def pixels(self):
+        """
+        Pixel (column,row) indices of the cells.
+
+        Held directly by landscapes read from GIS files; otherwise worked
+        out from x and y through the geotransform, or just truncated if
+        there isn't one.
+
+        Returns:
+        (px,py), int32 arrays.
+        """
+        if self.px is not None:
+            return self.px,self.py
+        if not self._georef():
+            return self.x.astype(np.int32),self.y.astype(np.int32)
+        return self._toPixels(self.x,self.y)
+
+    def _xy(self):
+        # The coordinates held: pixels if there are, x and y otherwise
+        if self.px is not None:
+            return self.px,self.py
+        return self._x,self._y
+
+    def _sameGrid(self,l):
+        return (self._georef() and l._georef() and
+                tuple(self.attribs.geotransform)==tuple(l.attribs.geotransform))
+
+    def _xyOf(self,l):
+        # l's cells in this landscape's coordinates (see _xy())
+        if self.px is None:
+            return l.x,l.y
+        if l.px is not None and self._sameGrid(l):
+            return l.px,l.py
+        return self._toPixels(l.x,l.y)
+
+    def _keysWith(self,l):
+        # Integer keys for this landscape's and l's cells (see cellKeys()),
+        # from pixels when both are on the same grid
+        if self._sameGrid(l):
+            a,b=self.pixels()
+            c,d=l.pixels()
+        else:
+            a,b=self.x,self.y
+            c,d=l.x,l.y
+        return cellKeys(a,b,c,d)
+
+    def _new(self,a,b,v):
+        # A landscape in this one's coordinates (see _xy()) with its attribs
+        c=self.__class__()
+        if self.px is not None:
+            c.px=a
+            c.py=b
+            c._x=c._y=None
+        else:
+            c._x=a
+            c._y=b
+        c.v=v
+        c.attribs=self.attribs
+        return c
+
+    def _like(self,a,b,v):
+        # A new landscape with these vectors and this one's metadata
+        c=self._new(a,b,v)
+        c.gt=self.gt
+        c.fname=self.fname
+        c.name=self.name
+        c.firstFlow=self.firstFlow
+        c.lastFlow=self.lastFlow
+        return c
+
     @classmethod
     def fromVecs(cls,x,y,v=None,attribs=None):
         """
@@ -55,6 +382,28 @@ class Landscape(object):
         c.attribs=attribs
         return c
 
+    @classmethod
+    def fromPixels(cls,px,py,v,attribs):
+        """
+        Create a Landscape object from pixel indices on a GIS grid.
+
+        Args:
+        px: (1D numpy array), Pixel column of each cell.
+        py: (1D numpy array), Pixel row of each cell.
+        v: (1D numpy array), Value at the location.
+        attribs: (GISAttribs), Attributes of the grid, with its geotransform.
+
+        Returns:
+        Will return a Landscape object if successful.
+        """
+        c=cls()
+        c.px=np.asarray(px,np.int32)
+        c.py=np.asarray(py,np.int32)
+        c._x=c._y=None
+        c.v=v
+        c.attribs=attribs
+        return c
+
     @classmethod
     def fromScalers(cls,x,y,v=None,attribs=None):
         """
@@ -100,68 +449,58 @@ class Landscape(object):
         c=cls.fromVecs(x,y,a)
 
     @classmethod
-    def fromGIS(cls,filename, makeone = False):
+    def fromGIS(cls,filename, makeone = False, cache = None):
         """
         Create a Landscape object from a GIS file. Uses GDAL.
 
+        The raster is read in windows aligned to its own blocks (see
+        readHabitat()), so only the habitat cells are ever held, not the
+        whole image. Cells equal to the band's no data value are not
+        habitat. The cells are held as pixel indices; x and y (km) are
+        worked out when first used.
+
         Args:
         filename: (string), Name of the file to open.
+        makeone: (bool), Give every habitat cell quality 1.
+        cache: (FileCache, Optional), Keep the parsed cells here and
+               reuse them while the file's content is unchanged.
 
         Returns:
         Will return a Landscape object if successful.
         """
-        gd=gdal.Open(filename)
-        h=np.array(gd.GetRasterBand(1).ReadAsArray())
-        
-        np.set_printoptions(threshold=np.nan)
-        
-        hab=np.where(h>0)
-        dataset = gd
-        geotransform = dataset.GetGeoTransform()
-        
-        y=hab[0]
-        x=hab[1]
-        a=h[y,x]*1.0 
-        
-        x = x * geotransform[1]  
-        x = x + geotransform[0] 
-        
-        y = y * geotransform[5] 
-        y = y + geotransform[3]
-        
-        x = x / 1000
-        y = y / 1000
-        
-        y = y - 0.5
-        x = x + 0.5
- 
+        if cache is None:
+            vecs,attr=cls._readGIS(filename)
+        else:
+            vecs,attr=cache.fetch(filename,cls._readGIS,GIS_CACHE_TAG)
+            # Entries are keyed by content, so may have been read from
+            # another copy of the file
+            attr.filename=filename
+        a=vecs['v']
         if makeone:
             a = np.ones(a.size)
- 
-        
-        attr=ga.GISAttribs.fromFile(filename)
-      
-        c=cls.fromVecs(x,y,a,attribs=attr)
-        return c
-        
-    def restoreToBitmap(self):    
-        geotransform = self.attribs.geotransform
-        self.y = self.y + 0.5
-        self.x = self.x - 0.5
-        
-        self.x = self.x * 1000
-        self.y = self.y * 1000
 
-        self.x = self.x - geotransform[0] 
-        self.y = self.y - geotransform[3]
-        
-        self.x = self.x / geotransform[1]  
-        self.y = self.y / geotransform[5] 
-        
-     
-        
-        
-        
+        return cls.fromPixels(vecs['px'],vecs['py'],a,attr)
+
+    @staticmethod
+    def _readGIS(filename):
+        # Pixel indices, values and attributes of a GIS file, for fromGIS()
+        gd=gdal.Open(filename, gdal.GA_ReadOnly)
+        attr=ga.GISAttribs.fromDataset(gd,filename)
+        py,px,a=readHabitat(gd.GetRasterBand(1),attr.ndv)
+        return {'px':px.astype(np.int32),'py':py.astype(np.int32),'v':a},attr
+
+    def restoreToBitmap(self):
+        """
+        Hold the cells as pixel indices (see pixels()), as fromGIS() does.
+        x and y are unchanged. image() and export() work from the pixels
+        either way, so this is no longer needed before them.
+        """
+        if self.px is None and self._georef():
+            x,y=self._x,self._y
+            self.px,self.py=self._toPixels(x,y)
+            self._x,self._y=x,y
+            self._buf=None
+
     @classmethod
     def fromImage(cls,h, mincut=0.0):
         """
@@ -196,24 +535,23 @@ class Landscape(object):
         pass
 
     def isin_(self,xnew,ynew,x,y):
-        for i in range(x.size):
-            if (xnew == x[i] and ynew == y[i]):
-                return True
-        return False
+        return bool(np.any((x==xnew) & (y==ynew)))
 
     def removeDups_(self,x,y,ap,xnew,ynew,apnew):
-        xr=[]
-        yr=[]
-        apr=[]
-        for i in range(xnew.size):
-            if not self.isin_(xnew[i],ynew[i],x,y):
-                xr.append(xnew[i])
-                yr.append(ynew[i])
-                apr.append(apnew[i])
-        nxr=np.array(xr)
-        nyr=np.array(yr)
-        napr=np.array(apr)
-        return nxr,nyr,napr
+        knew,k=cellKeys(xnew,ynew,x,y)
+        keep=~np.in1d(knew,k)
+        return xnew[keep],ynew[keep],apnew[keep]
+
+    def memberMask(self,l):
+        """
+        Boolean mask, aligned with this landscape, that is True for the
+        cells that are also in l.
+
+        Args:
+        l: (Landscape), The other landscape.
+        """
+        k,kl=self._keysWith(l)
+        return np.in1d(k,kl)
 
     def __repr__(self):
         s="Landscape Object:\n"
@@ -238,11 +576,11 @@ class Landscape(object):
     
     def __add__(self,l):
         v=self.v+l.v
-        return self.fromVecs(self.x,self.y,v,attribs=self.attribs)
+        return self._new(*self._xy()+(v,))
 
     def __mul__(self,l):
         v=self.v*l.v
-        return self.fromVecs(self.x,self.y,v,attribs=self.attribs)
+        return self._new(*self._xy()+(v,))
         
     def __add__old(self,l):
         logging.debug("Overloaded add operator. Don't use me! Use 'append()' instead.")
@@ -256,10 +594,9 @@ class Landscape(object):
         self.attribs=ga.GISAttribs(fn)
     
     def __getitem__(self,index):
-        x=np.array(self.x[index])
-        y=self.y[index]
-        v=self.v[index]
-        return self.fromVecs(x,y,v)
+        # Slices are views onto this landscape's vectors
+        a,b=self._xy()
+        return self._new(a[index],b[index],self.v[index])
 
     def argmax(self):
         """
@@ -294,27 +631,54 @@ class Landscape(object):
         The index of the minimum value in the landscape.
         """
         return np.argmin(self.v)
-    
-        
-    maxWidth = None
+
+    def argminK(self,k,mask=None):
+        """
+        Returns the indices of the k smallest values, smallest first. Equal
+        values come in index order.
+
+        Args:
+        k: (int), Number of indices wanted.
+        mask: (1D bool array, Optional), Only consider cells where mask is
+              True (see memberMask()).
+
+        Returns:
+        1D array of indices. Shorter than k if there are fewer cells.
+        """
+        idx=np.arange(self.v.size) if mask is None else np.flatnonzero(mask)
+        k=min(k,idx.size)
+        if k<=0:
+            return np.empty(0,np.int_)
+        v=self.v[idx]
+        if k<idx.size:
+            # Everything below the k-th value, then ties at it in index order
+            t=v[np.argpartition(v,k-1)[k-1]]
+            below=np.flatnonzero(v<t)
+            ties=np.flatnonzero(v==t)[:k-below.size]
+            sel=np.concatenate((below,ties))
+        else:
+            sel=np.arange(idx.size)
+        sel=sel[np.lexsort((sel,v[sel]))]
+        return idx[sel]
     
     @classmethod
     def make_location_key(cls,x,y):
-     # maxWidth is just used to make a numerical key from x,y co-ordinates, (i.e. key = y*maxWidth + x) 
-     # and hence slightly faster lookup to check for set membership
+     # Pixel indices on a GIS grid; otherwise the exact coordinates, so
+     # fractional positions can't collide
+        if isinstance(x,(int,long,np.integer)):
+            return (int(x),int(y))
+        return (float(x),float(y))
+
+    def _locationKeys(self):
+        # make_location_key() of every cell
+        if self._georef():
+            a,b=self.pixels()
+            return zip(a.tolist(),b.tolist())
+        return zip(np.asarray(self.x,float).tolist(),np.asarray(self.y,float).tolist())
 
-        return (y*cls.maxWidth)+x
-        
     @classmethod	
     def getKeySet(cls,restorationLandscape):
-        if cls.maxWidth is None:
-            cls.maxWidth = int(max(restorationLandscape.x)*2)
-        habitatList = []
-        for i in range(restorationLandscape.x.size):
-            key = Landscape.make_location_key(restorationLandscape.x[i],restorationLandscape.y[i])
-            habitatList.append(key)
-   
-        return set(habitatList)  
+        return set(restorationLandscape._locationKeys())
         
  
  
@@ -326,22 +690,16 @@ class Landscape(object):
         restorationLandscapeSet: (set) A set of keys that describe just the landscape to be restored
         Returns:
         The index of the minimum value in the landscape.
-        """
 
-        
-   
-
-        lowest = -1
-        for i in range(1, self.v.size):
-            if lowest < 0 or self.v[i] < self.v[lowest]:
-                key = self.make_location_key(self.x[i],self.y[i])
-                if key in restorationLandscapeSet:
-                    if key not in ignoreSet:
-                        lowest = i
-     
-        if lowest < 0:
+        For repeated selection, build a mask once with memberMask() and
+        use argminK() instead.
+        """
+        keys=self._locationKeys()
+        mask=np.array([k in restorationLandscapeSet and k not in ignoreSet for k in keys],bool)
+        lowest=self.argminK(1,mask)
+        if lowest.size==0:
              raise ValueError("cannot find a cell to drop which is in the restorationLandscapeSet")     
-        return lowest;
+        return lowest[0]
         
         
     def min(self):
@@ -367,16 +725,18 @@ class Landscape(object):
         Returns a Landscape object with the points that have been extracted.
         """
         w=np.where(self.v==level)
-        return self.fromVecs(self.x[w],self.y[w],self.v[w])
+        a,b=self._xy()
+        return self._new(a[w],b[w],self.v[w])
 
     def where(self,q):
         return np.where(q)
 
     def assign(self,l):
-        self.x=l.x
-        self.y=l.y
+        self.px,self.py=l.px,l.py
+        self._x,self._y=l._x,l._y
         self.v=l.v
         self.attribs=l.attribs
+        self._buf=None
         
     def len(self):
         """
@@ -387,7 +747,7 @@ class Landscape(object):
         Returns:
         The integer number of points in the landscape.
         """
-        return self.x.size
+        return self._xy()[0].size
 
     def xlen(self):
         """
@@ -398,7 +758,7 @@ class Landscape(object):
         Returns:
         The integer number of points in the x array.
         """
-        return self.x.size
+        return self._xy()[0].size
 
     def ylen(self):
         """
@@ -409,7 +769,7 @@ class Landscape(object):
         Returns:
         The integer number of points in the y array.
         """
-        return self.y.size
+        return self._xy()[1].size
 
     def imageSize(self):
         """
@@ -455,7 +815,8 @@ class Landscape(object):
             z=self.imageSize()
             z2=self._biggest(size,z)
             a=np.zeros(z2)
-        a[self.x.astype(int),self.y.astype(int)]=self.v
+        px,py=self.pixels()
+        a[px,py]=self.v
         return a
 
     ####### Obsolete ##########
@@ -524,10 +885,44 @@ class Landscape(object):
 
         Returns:
         """
-        x,y,v=self.removeDups_(testl.x,testl.y,testl.v,self.x,self.y,self.v)
-        self.x=x
-        self.y=y
-        self.v=v
+        self.remove(self.memberMask(testl))
+
+    def union(self,l):
+        """
+        Return a new landscape with the cells of both landscapes. Cells
+        in both keep their values from this one.
+
+        Args:
+        l: (Landscape), The other landscape.
+        """
+        new=~l.memberMask(self)
+        a,b=self._xy()
+        la,lb=self._xyOf(l)
+        return self._new(np.append(a,la[new]),np.append(b,lb[new]),np.append(self.v,l.v[new]))
+
+    def intersection(self,l):
+        """
+        Return a new landscape with the cells of this landscape that are
+        also in l.
+
+        Args:
+        l: (Landscape), The other landscape.
+        """
+        w=self.memberMask(l)
+        a,b=self._xy()
+        return self._new(a[w],b[w],self.v[w])
+
+    def difference(self,l):
+        """
+        Return a new landscape with the cells of this landscape that are
+        not in l.
+
+        Args:
+        l: (Landscape), The other landscape.
+        """
+        w=~self.memberMask(l)
+        a,b=self._xy()
+        return self._new(a[w],b[w],self.v[w])
 
     def copy(self):
         """
@@ -536,24 +931,44 @@ class Landscape(object):
         Args:
         
         Returns:
-        (Landscape) An exact copy of the landscape.
+        (Landscape) A copy of the landscape. The x, y and v vectors are
+        copied; attribs are shared.
         """
-        return copy.deepcopy(self)
-        # x=copy.deepcopy(self.x)
-        # y=copy.deepcopy(self.y)
-        # v=copy.deepcopy(self.v)
-        # return self.fromVecs(x,y,v)
+        a,b=self._xy()
+        c=self._like(a.copy(),b.copy(),self.v.copy())
+        if self.px is not None and self._x is not None:
+            c._x,c._y=self._x.copy(),self._y.copy()
+        return c
 
     def delete(self,inds):
         """
         Return a new landscape with inds deleted.
+        See also 'remove()'.
         """
-#        logging.debug("WARNING: map projection info lost")
-        c=self.copy()
-        c.x=np.delete(self.x,inds)
-        c.y=np.delete(self.y,inds)
-        c.v=np.delete(self.v,inds)
-        return c
+        a,b=self._xy()
+        return self._like(np.delete(a,inds),np.delete(b,inds),np.delete(self.v,inds))
+
+    def remove(self,inds):
+        """
+        Delete inds (indices or a boolean mask) from this landscape.
+        This will modify the landscape object. See also 'delete()'.
+        """
+        drop=np.zeros(self.len(),bool)
+        drop[inds]=True
+        self._keep(~drop)
+
+    def _keep(self,w):
+        # Keep only the cells in mask w, in place
+        if self.px is not None:
+            self.px=self.px[w]
+            self.py=self.py[w]
+            if self._x is not None:
+                self._x=self._x[w]
+                self._y=self._y[w]
+        else:
+            self._x=self._x[w]
+            self._y=self._y[w]
+        self.v=self.v[w]
     
     def append(self,l,clip=True):
         """
@@ -562,22 +977,40 @@ class Landscape(object):
         See also 'grow()'
         """
 #        xz,yz=self.imageSize()
-        c=self.copy()
-        c.x=np.append(self.x,l.x)
-        c.y=np.append(self.y,l.y)
-        c.v=np.append(self.v,l.v)
-        return c
+        a,b=self._xy()
+        la,lb=self._xyOf(l)
+        return self._like(np.append(a,la),np.append(b,lb),np.append(self.v,l.v))
 
     def grow(self,l,clipsize=None):
         """
         Append a new landscape. This will modify the landscape object.
         Returns nothing. See also 'append()'.
+
+        Space is reserved in doubling steps, so growing a landscape one
+        cell at a time costs amortised constant time per cell.
         """
         if not clipsize == None:
             l.clip(clipsize)
-        self.x=np.append(self.x,l.x)
-        self.y=np.append(self.y,l.y)
-        self.v=np.append(self.v,l.v)
+        cur=self._xy()+(self.v,)
+        new=[np.asarray(a).ravel() for a in self._xyOf(l)+(l.v,)]
+        n=cur[0].size
+        m=new[0].size
+        b=self._buf
+        if (b is None or b[0].size<n+m
+            or not all(a.base is bb and a.size==n for a,bb in zip(cur,b))
+            or not all(np.result_type(bb,a)==bb.dtype for a,bb in zip(new,b))):
+            cap=max(2*(n+m),16)
+            b=tuple(np.empty(cap,np.result_type(a,na)) for a,na in zip(cur,new))
+            for bb,a in zip(b,cur):
+                bb[:n]=a
+            self._buf=b
+        for bb,a in zip(b,new):
+            bb[n:n+m]=a
+        if self.px is not None:
+            self.px,self.py,self.v=[bb[:n+m] for bb in b]
+            self._x=self._y=None
+        else:
+            self._x,self._y,self.v=[bb[:n+m] for bb in b]
 
     def clip(self,clipsize):
         """
@@ -587,9 +1020,7 @@ class Landscape(object):
         xz,yz=clipsize
         w=[(self.x<0) | (self.x>xz) | (self.y<0) | (self.y>yz)]
         w=np.logical_not(w[0])
-        self.x=self.x[w]
-        self.y=self.y[w]
-        self.v=self.v[w]
+        self._keep(w)
         
     def scalexy(self,k):
         self.x=self.x*k
@@ -630,34 +1061,21 @@ class Landscape(object):
     def export_old(self,fname):
         writeGeoFile(self.image(),fname,self.attribs.fileName)
 
-    def export(self,newFileName):
-        attribs=self.attribs
-        a=self.image()
-        print a.shape
-        NDV=0
-        if attribs:
-            NDV = attribs.ndv
-        if not NDV:
-            NDV=0
-        xsize = attribs.xsize
-        ysize = attribs.ysize
-        GeoT = attribs.geotransform
-        Projection = osr.SpatialReference()
-        Projection.ImportFromWkt(attribs.projectionref)
-        dtype=gdal.GDT_Float64
-        driver = gdal.GetDriverByName("GTiff")
-        DataSet = driver.Create( newFileName, xsize, ysize, 1, dtype )
-        DataSet.SetGeoTransform(GeoT)
-        DataSet.SetProjection( Projection.ExportToWkt() )
-        DataSet.GetRasterBand(1).WriteArray(np.transpose(a).astype(np.float64))
-        DataSet.GetRasterBand(1).SetNoDataValue(NDV)
-        logging.info("GIS file %s written" % newFileName)
+    def export(self,newFileName,dtype=np.float64,compress='DEFLATE',blockSize=256):
+        """
+        Write the landscape to a GeoTIFF on its GIS grid (see writeGeoTIFF()).
+
+        Args:
+        newFileName: (string), Name of the file to write.
+        dtype: (numpy dtype), Type of the values in the file.
+        compress: (string), GeoTIFF compression, or None.
+        blockSize: (int), Side of the square tiles.
+        """
+        writeGeoTIFF(newFileName,[self],dtype=dtype,compress=compress,blockSize=blockSize)
 
     def exportCSV(self,fname):
-        with open(fname, 'w') as f:
-            for i in range(self.len()):
-                s="%i,%e,%e,%e\n" % (i,self.x[i],self.y[i],self.v[i])
-                f.write(s)
+        tablewriter.writeTable(fname,['i','x','y','v'],[np.arange(self.len()),self.x,self.y,self.v],
+                               ['%i','%e','%e','%e'],header='')
 
     def toLonLat(self):
         """
@@ -10,10 +10,10 @@ import ftplib
 from paramiko import SSHClient
 import paramiko
 import log_all
+import filecache
 
 def makeImage(file, filterV =  None):
-    land =ls.Landscape.fromGIS(file,makeone=False)
-    land.restoreToBitmap()
+    land =ls.Landscape.fromGIS(file,makeone=False,cache=filecache.default())
  
     if filterV is not None:
         land.v = land.v == filterV
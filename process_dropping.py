@@ -15,6 +15,9 @@ import make_thumb
 import traceback
 import log_all
 import serverio
+import candidatepool
+import filecache
+import tablewriter
     
 # Previous versions allowed voltages to be scaled by a constant factor
 scaleVoltage = 1
@@ -24,7 +27,7 @@ def createHabitat(h5,landscapeFile,STFile):
         h5.removeNode("/scenarios/root",recursive=True)
     
     log_all.log("get landscape")    
-    l=ls.Landscape.fromGIS(landscapeFile,makeone=False)
+    l=ls.Landscape.fromGIS(landscapeFile,makeone=False,cache=filecache.default())
  
    
     l.scalev(scaleVoltage)
@@ -36,7 +39,7 @@ def createHabitat(h5,landscapeFile,STFile):
         
     c=chdf.CondatisCoreHDF.fromLandscape(h5,'root',l)
     log_all.log("get st")    
-    st=ls.Landscape.fromGIS(STFile)
+    st=ls.Landscape.fromGIS(STFile,cache=filecache.default())
     
     log_all.log("add source")
     c.addSource(st.level(1))
@@ -51,7 +54,10 @@ def createHabitat(h5,landscapeFile,STFile):
 	# the jobid may be required to identify this instance to the server
 	# thumbFile may be an image file for a thumbnail, which will be passed to the server as html
 
-def drop(c,restorationLandscape, N=None, loopParamOne = .85, loopScale = 1, loopParam = 1, connection=None,outputdata="outdata.csv",previewOnly = False,jobid = 1, thumbFile = None):
+    # candidates, if set, switches the choice of cells from lowest flow to
+    # lowest exact speed loss: each round that many lowest flow cells are
+    # evaluated in parallel (nproc workers) and the least damaging dropped
+def drop(c,restorationLandscape, N=None, loopParamOne = .85, loopScale = 1, loopParam = 1, connection=None,outputdata="outdata.csv",previewOnly = False,jobid = 1, thumbFile = None, candidates = None, nproc = None, outputFormat = 'csv'):
     
     if not N:
         N=c.habitatL().len()
@@ -139,7 +145,6 @@ def drop(c,restorationLandscape, N=None, loopParamOne = .85, loopScale = 1, loop
         return result
     
 	
-    restorationLandscapeSet = ls.Landscape.getKeySet(restorationLandscape)
     cpuIndex = multiprocessing.cpu_count()* 150
 
     if N > cpuIndex:
@@ -148,88 +153,114 @@ def drop(c,restorationLandscape, N=None, loopParamOne = .85, loopScale = 1, loop
 
     loopParam = loopParam * loopScale   + (1* (1-loopScale))
  
-    outputDataFile = open(outputdata,'w')
-    outputDataFile.write("i,Speed,x,y,flow\n")
+    # The rows are written in blocks; the CSV header is the one it has always had
+    outputDataFile = tablewriter.TableWriter(outputdata,['i','speed','x','y','flow','cell'],
+                                             ['%i','%e','%f','%f','%e','%i'],fmt=outputFormat,
+                                             header="i,Speed,x,y,flow\n")
     
-    # Dropping loop
-    i = 1
-    for k in range(N-1):
-      
+    pool = None
+    try:
+        # Dropping loop. The kernel for the full habitat is computed and the
+        # system solved once here; after that removeNodes() cuts them down and
+        # updates the solution for each batch of removals. (No cacheKernel():
+        # removeNodes() never gathers from it, and it would hold another N x N.)
         c2.calc()
-        sp=c2.speed()
-        # checks against the feasible habitat
-        nodeFlow = c2.nodeFlowL()
-
-		# storing the first flow for later reporting
-        if i == 1:
-            result.firstFlow = nodeFlow
-        maxVoltage = max(c2.habitatL().v)
-        if maxVoltage > 1.1:
-            print "out of range"
-            raise ValueError("Failed with an out of range voltage  "+str(maxVoltage))
+        # Cells that may be dropped, kept aligned with c2's habitat
+        feasible = c2.habitatL().memberMask(restorationLandscape)
+        if candidates:
+            if candidatepool.CandidatePool.supports(c2):
+                pool = candidatepool.CandidatePool(c2.x().size,nproc)
+            else:
+                logging.warning("drop(): candidate evaluation needs a dense float64 system, using lowest flow")
+        i = 1
+        for k in range(N-1):
+      
+            sp=c2.speed()
+            # checks against the feasible habitat
+            nodeFlow = c2.nodeFlowL()
+
+    		# storing the first flow for later reporting
+            if i == 1:
+                result.firstFlow = nodeFlow
+            maxVoltage = np.max(c2.ap())
+            if maxVoltage > 1.1:
+                print "out of range"
+                raise ValueError("Failed with an out of range voltage  "+str(maxVoltage))
         
         
-        # Get (feasible) node with smallest flow
-        ignoreSet=set()
-        smallestList=[]
+            # Get (feasible) node with smallest flow
+            smallestList=[]
         
-        if connection is not None:
-            if connection.progressReport is not None:
-                connection.progressReport((i*100.0)/N)
+            if connection is not None:
+                if connection.progressReport is not None:
+                    connection.progressReport((i*100.0)/N)
 
-		# work out how many cells to drop in this iteration 
+    		# work out how many cells to drop in this iteration 
 				
-        loopSize = int (((N-i*1.0)/N) * loopParam ) + 1
+            loopSize = int (((N-i*1.0)/N) * loopParam ) + 1
 
-		# don't drop more than we have
-        if loopSize > N-i:
-            loopSize = N -i + 1
+    		# don't drop more than we have
+            if loopSize > N-i:
+                loopSize = N -i + 1
         
-		# e.g., only drop individually for most significant cells
-        if i > (N*loopParamOne):   
-            loopSize = 1
+    		# e.g., only drop individually for most significant cells
+            if i > (N*loopParamOne):   
+                loopSize = 1
 
 
            
-        for j in range(loopSize):
-            smallest=nodeFlow.argminBoth(restorationLandscapeSet,ignoreSet)
-            smallestList.append(smallest)
-
-        # Create landscape object from the smallest flow
-        # set value to i and append to result
-            l=c2.habitatL()[smallest]
-            ignoreSet.add( ls.Landscape.make_location_key(l.x,l.y) )
-        
-            l.v=i
-            result=result.append(l)
-
-        land=c2.habitatL()
-        
-        smallestList.sort(reverse=True)
-
-        # Remove the nodes with the smallest flow
-
-        for smallest in smallestList:
-            l=c2.habitatL()[smallest]
-            nodeFlow = c2.nodeFlow()[smallest]
-            log_all.log("%i out of %i, Speed: %e  x,y = %f,%f, i= %e, %i" % (i,N,sp,l.x,l.y,c2.nodeFlow()[smallest],smallest))
-            logging.info("%i out of %i, Speed: %e  x,y = %f,%f, i= %e, %i" % (i,N,sp,l.x,l.y,c2.nodeFlow()[smallest],smallest))
-            outputDataFile.write("%i,%e,%f,%f,%e,%i\n" % (i,sp,l.x,l.y,nodeFlow,smallest))
-            c2.modifyHabitat(land.delete(smallest))
-            i = i + 1
-            if connection is not None:
-                if connection.progressReport is not None:
-                    connection.progressReport((i*100.0)/N)
-
-        if i > N:
-            break
-
-    outputDataFile.close()
+            if pool is not None:
+                # Rank the lowest flow feasible cells by their exact speed loss
+                cands=nodeFlow.argminK(max(candidates,loopSize),feasible)
+                loss=pool.speedLoss(c2,cands)
+                ranked=cands[np.argsort(loss,kind='mergesort')]
+            else:
+                ranked=nodeFlow.argminK(loopSize,feasible)
+            if ranked.size < loopSize:
+                raise ValueError("cannot find a cell to drop which is in the restorationLandscapeSet")
+
+            for j in range(loopSize):
+                smallest=int(ranked[j])
+                smallestList.append(smallest)
+
+            # Create landscape object from the smallest flow
+            # set value to i and append to result
+                l=c2.habitatL()[smallest]
+                l.v=i
+                result.grow(l)
+
+            smallestList.sort(reverse=True)
+
+            # Report the nodes with the smallest flow
+
+            for smallest in smallestList:
+                l=c2.habitatL()[smallest]
+                nodeFlow = c2.nodeFlow()[smallest]
+                log_all.log("%i out of %i, Speed: %e  x,y = %f,%f, i= %e, %i" % (i,N,sp,l.x,l.y,c2.nodeFlow()[smallest],smallest))
+                logging.info("%i out of %i, Speed: %e  x,y = %f,%f, i= %e, %i" % (i,N,sp,l.x,l.y,c2.nodeFlow()[smallest],smallest))
+                outputDataFile.write(i,sp,l.x,l.y,nodeFlow,smallest)
+                i = i + 1
+                if connection is not None:
+                    if connection.progressReport is not None:
+                        connection.progressReport((i*100.0)/N)
+
+            # Remove them all and update the flow
+            if len(smallestList) >= c2.x().size:
+                break
+            c2.removeNodes(smallestList)
+            feasible = np.delete(feasible,smallestList)
+
+            if i > N:
+                break
+    finally:
+        # Also on errors, so the pool's workers and shared arrays go
+        outputDataFile.close()
+        if pool is not None:
+            pool.close()
     if connection is not None:
         if connection.progressReport is not None:
            connection.progressReport(100)
 
-    c2.calc()            
     result.lastFlow = c2.nodeFlowL()  
     return result
 
@@ -244,7 +275,7 @@ def drop(c,restorationLandscape, N=None, loopParamOne = .85, loopScale = 1, loop
 # very similar code to dropping, but only computes the flow
 
     
-def flow(c,restorationLandscape, N=None, loopParamOne = .85, loopScale = 1, loopParam = 1, connection=None,outputdata="outdata.csv",previewOnly = False,normalise = None, jobid=0, thumbFile=None):
+def flow(c,restorationLandscape, N=None, loopParamOne = .85, loopScale = 1, loopParam = 1, connection=None,outputdata="outdata.csv",previewOnly = False,normalise = None, jobid=0, thumbFile=None, outputFormat='csv'):
     
     if not N:
         N=c.habitatL().len()
@@ -312,19 +343,18 @@ def flow(c,restorationLandscape, N=None, loopParamOne = .85, loopScale = 1, loop
 
 
     nodeFlow = c2.nodeFlowL()
-    outputDataFile = open(outputdata,'w')
-    
-    outputDataFile.write("Speed =, %f\n" % sp)
-    outputDataFile.write("x,y,flow\n")
-    
-    for l in nodeFlow:
-       outputDataFile.write("%f,%f,%e\n" % (l.x,l.y,l.v))
+    if outputFormat == 'csv':
+        tablewriter.writeTable(outputdata,['x','y','flow'],[nodeFlow.x,nodeFlow.y,nodeFlow.v],
+                               ['%f','%f','%e'],header="Speed =, %f\nx,y,flow\n" % sp)
+    else:
+        # No header in a binary table, so the speed is a column
+        tablewriter.writeTable(outputdata,['speed','x','y','flow','voltage'],
+                               [np.full(nodeFlow.len(),sp),nodeFlow.x,nodeFlow.y,nodeFlow.v,c2.nodeVoltage()],
+                               fmt=outputFormat)
         
     if normalise is not None:
         maxVal = max(nodeFlow.v)
         nodeFlow.v = nodeFlow.v * normalise /maxVal
-        
-    outputDataFile.close()
          
     return nodeFlow
 
@@ -337,9 +367,15 @@ def doDropping(landscapeFile = "wawhab800.tif",
     R = 1000.0,
     dispersal = 5.0,
     outputFile ="outfile.tif",outputdata="outdata.csv",connection = None, previewOnly = False, flowOnly=False,
-    jobid=1
+    jobid=1, singleFile=False, outputFormat='csv'
     ):
 
+    # Drop order is written as int32 and flows as float32. With singleFile
+    # the drop order, start flow and end flow are bands 1-3 of outputFile
+    # (float32, which holds drop orders exactly) rather than three files.
+    # outputFormat is that of outputdata: 'csv', 'hdf' or 'parquet' (see
+    # tablewriter).
+
     log_all.log("Condatis doDropping called")                      
 
     
@@ -394,29 +430,28 @@ def doDropping(landscapeFile = "wawhab800.tif",
         if flowOnly:
 
             log_all.log("Call Compute flow")            
-            r=flow(k,None,connection=connection,outputdata=outputdata,previewOnly=previewOnly,jobid=jobid,thumbFile=thumbFile)
-            log_all.log("Call Restore to bitmap")            
-            r.restoreToBitmap()
+            r=flow(k,None,connection=connection,outputdata=outputdata,previewOnly=previewOnly,jobid=jobid,thumbFile=thumbFile,outputFormat=outputFormat)
             log_all.log("Call Export")            
-            r.export(outputFile)
+            r.export(outputFile,dtype=np.float32)
         else:
-            restorationLandscape =ls.Landscape.fromGIS(restorationFile,makeone=False)
+            restorationLandscape =ls.Landscape.fromGIS(restorationFile,makeone=False,cache=filecache.default())
 
             maxVoltage = max(restorationLandscape.v)
             minVoltage = min(restorationLandscape.v)
             if maxVoltage > 1.1 or minVoltage < -0.1:
                 restorationLandscape.scalev(1.0/100.0)
 
-            r=drop(k,restorationLandscape,connection=connection,outputdata=outputdata,previewOnly=previewOnly,jobid=jobid,thumbFile=thumbFile )
-            r.restoreToBitmap()
-            r.export(outputFile)
-            
-            if r.lastFlow is not None:
-                r.lastFlow.restoreToBitmap()
+            r=drop(k,restorationLandscape,connection=connection,outputdata=outputdata,previewOnly=previewOnly,jobid=jobid,thumbFile=thumbFile,outputFormat=outputFormat )
+            if singleFile and r.lastFlow is not None:
+                ls.writeGeoTIFF(outputFile,[r,r.firstFlow,r.lastFlow],dtype=np.float32,
+                                names=["drop order","start flow","end flow"])
+            else:
+                r.export(outputFile,dtype=np.int32)
+
+            if r.lastFlow is not None and not singleFile:
                 #don't forget to amend the filenames when copying to server - see condatis.py
-                r.lastFlow.export(outputFile[:-4]+"_endflow.tif")
-                r.firstFlow.restoreToBitmap()
-                r.firstFlow.export(outputFile[:-4]+"_startflow.tif")
+                r.lastFlow.export(outputFile[:-4]+"_endflow.tif",dtype=np.float32)
+                r.firstFlow.export(outputFile[:-4]+"_startflow.tif",dtype=np.float32)
             
         success = True
     except Exception, e:
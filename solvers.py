@@ -0,0 +1,214 @@
+import numpy as np
+from scipy import linalg
+from scipy import sparse
+from scipy.sparse import linalg as splinalg
+import logging
+
+try:
+    import pyamg
+except ImportError:
+    pyamg=None
+
+try:
+    from sksparse import cholmod
+except ImportError:
+    cholmod=None
+
+"""
+Linear solvers for the Condatis M0 system.
+
+M0 is symmetric and diagonally dominant (a graph Laplacian plus the
+source and target conductances on the diagonal), so as well as the
+general direct solve it can be handled by preconditioned conjugate
+gradient. All routines accept either a dense numpy array or a scipy
+sparse matrix.
+"""
+
+METHODS=('direct','cg')
+PRECONDITIONERS=('none','jacobi','ilu','amg')
+
+
+class SolveInfo(object):
+    """
+    Diagnostics from a single solve.
+
+    Attributes:
+    method: (string), Solver that was used.
+    precond: (string), Preconditioner that was used (iterative only).
+    iterations: (int), Number of iterations (0 for direct solves).
+    residual: (number), Relative residual |b-Mx|/|b| of the answer.
+    converged: (bool), False if the iterative solver hit maxiter.
+    """
+    def __init__(self,method,precond=None):
+        self.method=method
+        self.precond=precond
+        self.iterations=0
+        self.residual=0.0
+        self.converged=True
+
+    def __repr__(self):
+        s="Solve Info:\n"
+        s+="Method: %s" % self.method + '\n'
+        s+="Preconditioner: %s" % self.precond + '\n'
+        s+="Iterations: %d" % self.iterations + '\n'
+        s+="Residual: %e" % self.residual + '\n'
+        s+="Converged: %s" % self.converged
+        return s
+
+
+def residual(M,b,x):
+    """
+    Relative residual |b-Mx|/|b|.
+    """
+    nb=np.linalg.norm(b)
+    if nb==0:
+        nb=1.0
+    return np.linalg.norm(b-M.dot(x))/nb
+
+
+class Factor(object):
+    """
+    A reusable factorisation of M, for repeated solves against it.
+
+    Dense matrices use a LAPACK Cholesky factor. Sparse matrices use
+    CHOLMOD when scikit-sparse is installed and SuperLU otherwise.
+    """
+    def __init__(self,M):
+        self.shape=M.shape
+        if sparse.issparse(M):
+            if cholmod is not None:
+                self.kind='cholmod'
+                self.fac_=cholmod.cholesky(sparse.csc_matrix(M))
+            else:
+                self.kind='splu'
+                self.fac_=splinalg.splu(sparse.csc_matrix(M))
+        else:
+            self.kind='cholesky'
+            self.fac_=linalg.cho_factor(M,lower=True,check_finite=False)
+
+    def solve(self,b):
+        """
+        Solve M x = b. b may be a vector or an N x k array of right hand sides.
+        """
+        if self.kind=='cholesky':
+            return linalg.cho_solve(self.fac_,b,check_finite=False)
+        if self.kind=='cholmod':
+            return self.fac_(b)
+        return self.fac_.solve(b)
+
+
+def factor(M):
+    """
+    Factorise M for repeated solves. See Factor.
+    """
+    return Factor(M)
+
+
+def _diagonal(M):
+    if sparse.issparse(M):
+        return M.diagonal()
+    return np.diag(M).copy()
+
+
+def jacobi(M,diag=None):
+    """
+    Jacobi (diagonal) preconditioner for M. Pass diag when M is an
+    operator whose diagonal can't be read off.
+    """
+    d=_diagonal(M) if diag is None else np.array(diag,float)
+    d[d==0]=1.0
+    inv=1.0/d
+    return splinalg.LinearOperator(M.shape,matvec=lambda r: inv*np.ravel(r),dtype=inv.dtype)
+
+
+def ilu(M,drop_tol=1e-4,fill_factor=10):
+    """
+    Incomplete factorisation preconditioner for M.
+
+    scipy has no incomplete Cholesky, so this uses its incomplete LU
+    (SuperLU). On a symmetric matrix it plays the same role.
+    """
+    fac=splinalg.spilu(sparse.csc_matrix(M),drop_tol=drop_tol,fill_factor=fill_factor)
+    return splinalg.LinearOperator(M.shape,matvec=fac.solve,dtype=fac.L.dtype)
+
+
+def amg(M):
+    """
+    Smoothed aggregation algebraic multigrid preconditioner for M.
+    Needs pyamg.
+    """
+    if pyamg is None:
+        raise ValueError("solvers.amg(): pyamg is not installed")
+    ml=pyamg.smoothed_aggregation_solver(sparse.csr_matrix(M))
+    return ml.aspreconditioner()
+
+
+def preconditioner(M,name):
+    """
+    Build the named preconditioner for M.
+
+    Args:
+    M: (2D array or sparse matrix), The system matrix.
+    name: (string), One of 'none', 'jacobi', 'ilu', 'amg'.
+
+    Returns:
+    A LinearOperator approximating M^-1, or None for 'none'.
+    """
+    if name is None or name=='none':
+        return None
+    if name=='jacobi':
+        return jacobi(M)
+    if name=='ilu':
+        return ilu(M)
+    if name=='amg':
+        return amg(M)
+    raise ValueError("solvers.preconditioner(): unknown preconditioner '%s'" % name)
+
+
+def solve(M,b,method='direct',tol=1e-8,x0=None,precond='jacobi',maxiter=None,fac=None):
+    """
+    Solve M x = b.
+
+    Args:
+    M: (2D array or sparse matrix), Symmetric positive definite matrix.
+    b: (1D array), Right hand side.
+    method: (string), 'direct' or 'cg' (preconditioned conjugate gradient).
+    tol: (number), Relative tolerance for iterative methods.
+    x0: (1D array, Optional), Initial guess for iterative methods.
+    precond: (string or LinearOperator), Preconditioner name (see
+             preconditioner()) or a ready-made operator.
+    maxiter: (int, Optional), Iteration limit for iterative methods.
+    fac: (Factor, Optional), Existing factorisation of M for 'direct'.
+
+    Returns:
+    (x,info), The solution and a SolveInfo.
+    """
+    if method=='direct':
+        info=SolveInfo(method)
+        if fac is None:
+            fac=factor(M)
+        x=fac.solve(b)
+    elif method=='cg':
+        if isinstance(precond,basestring) or precond is None:
+            info=SolveInfo(method,precond)
+            P=preconditioner(M,precond)
+        else:
+            info=SolveInfo(method,'custom')
+            P=precond
+        count=[0]
+        def callback(xk):
+            count[0]+=1
+        # M0 entries are tiny (K scales with cell^4), so the stopping test
+        # must be purely relative: atol=0.
+        x,flag=splinalg.cg(M,b,x0=x0,tol=tol,atol=0.0,maxiter=maxiter,M=P,callback=callback)
+        info.iterations=count[0]
+        info.converged=(flag==0)
+        if flag>0:
+            logging.warning("solvers.solve(): cg did not converge in %d iterations" % flag)
+        elif flag<0:
+            raise ValueError("solvers.solve(): cg failed (illegal input or breakdown)")
+    else:
+        raise ValueError("solvers.solve(): unknown method '%s'" % method)
+    info.residual=residual(M,b,x)
+    logging.debug("solvers.solve(): %s, %d iterations, residual %e" % (method,info.iterations,info.residual))
+    return x,info
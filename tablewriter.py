@@ -0,0 +1,140 @@
+import numpy as np
+import pandas as pd
+import logging
+
+"""
+Bulk writers for tables of results (one row per habitat cell).
+
+Rows are gathered into column arrays and written in blocks. CSV text for
+a whole block is made by a single '%' formatting call over all of its
+values, rather than formatting (and indexing) row by row, so it comes
+out exactly as the old line by line output did. The same tables can be
+written in binary, column by column: 'hdf' (a pandas HDFStore table,
+through pytables) or 'parquet' (needs pyarrow or fastparquet). Both are
+read back with pandas.read_hdf() / pandas.read_parquet().
+"""
+
+FORMATS=('csv','hdf','parquet')
+
+# Key of the table in an 'hdf' file
+HDF_KEY='nodes'
+
+
+def formatRows(fmt,cols):
+    """
+    Text of rows, row i being fmt % (cols[0][i],cols[1][i],...).
+
+    Args:
+    fmt: (string), Format of one row, newline included.
+    cols: (list of 1D arrays), The columns, all the same length.
+    """
+    n=len(cols[0])
+    if not n:
+        return ''
+    vals=np.empty((n,len(cols)),object)
+    for k,c in enumerate(cols):
+        vals[:,k]=c
+    return (fmt*n) % tuple(vals.ravel())
+
+
+class TableWriter(object):
+    """
+    Write a table to a file, a block of rows at a time.
+
+    Args:
+    fname: (string), Name of the file to write.
+    names: (list of strings), Column names.
+    formats: (list of strings, Optional), '%' format of each column in
+             CSV. Defaults to '%e'.
+    fmt: (string), One of FORMATS.
+    header: (string, Optional), Text written at the top of a CSV instead
+            of a line of column names.
+    flushRows: (int), Rows held before they are written out.
+
+    Rows may be added one at a time or many at once (see write()). Call
+    close() when done.
+    """
+    def __init__(self,fname,names,formats=None,fmt='csv',header=None,flushRows=65536):
+        if fmt not in FORMATS:
+            raise ValueError("TableWriter: unknown format '%s'" % fmt)
+        self.fname=fname
+        self.names=list(names)
+        if formats is None:
+            formats=['%e']*len(self.names)
+        self.rowFormat=','.join(formats)+'\n'
+        self.fmt=fmt
+        self.flushRows=flushRows
+        self.cols=[[] for c in self.names]
+        self.held=0
+        self.store=None
+        self.file=None
+        if fmt=='csv':
+            self.file=open(fname,'w')
+            self.file.write(','.join(self.names)+'\n' if header is None else header)
+        elif fmt=='hdf':
+            self.store=pd.HDFStore(fname,'w')
+
+    def write(self,*cols):
+        """
+        Add rows: one value or 1D array per column, in the order of names.
+        """
+        if len(cols)!=len(self.names):
+            raise ValueError("TableWriter.write(): %d columns given, table has %d" % (len(cols),len(self.names)))
+        cols=[np.atleast_1d(c) for c in cols]
+        for held,c in zip(self.cols,cols):
+            held.append(c)
+        self.held+=cols[0].size
+        if self.held>=self.flushRows and self.fmt!='parquet':
+            self.flush()
+
+    def _take(self):
+        cols=[np.concatenate(c) if c else np.empty(0) for c in self.cols]
+        self.cols=[[] for c in self.names]
+        self.held=0
+        return cols
+
+    def flush(self):
+        """
+        Write out the rows held. Parquet is written whole on close().
+        """
+        if not self.held or self.fmt=='parquet':
+            return
+        cols=self._take()
+        if self.fmt=='csv':
+            n=cols[0].size
+            for s in range(0,n,self.flushRows):
+                self.file.write(formatRows(self.rowFormat,[c[s:s+self.flushRows] for c in cols]))
+            self.file.flush()
+        else:
+            self.store.append(HDF_KEY,pd.DataFrame(dict(zip(self.names,cols)),columns=self.names),index=False)
+
+    def close(self):
+        """
+        Write out anything held and close the file.
+        """
+        if self.fmt=='parquet':
+            cols=self._take()
+            try:
+                pd.DataFrame(dict(zip(self.names,cols)),columns=self.names).to_parquet(self.fname)
+            except ImportError, e:
+                raise ValueError("TableWriter: parquet needs pyarrow or fastparquet (%s)" % e)
+        else:
+            self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file=None
+        if self.store is not None:
+            self.store.close()
+            self.store=None
+        logging.debug("TableWriter: %s written" % self.fname)
+
+
+def writeTable(fname,names,cols,formats=None,fmt='csv',header=None):
+    """
+    Write whole columns as a table in one go. See TableWriter.
+    """
+    w=TableWriter(fname,names,formats,fmt,header)
+    try:
+        w.write(*cols)
+    finally:
+        w.close()